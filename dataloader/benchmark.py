@@ -0,0 +1,400 @@
+"""
+Per-stage benchmark of the dataset loaders on synthetic fixtures
+
+Fixtures are written in each native format (no network), then every
+dataset is timed stage by stage:
+    discovery  data_path() of all subjects
+    decode     native file reading only (edf/txt/mat -> arrays)
+    load       _get_single_subject_data() (decode + RawArray + dataset processing)
+    filter     8-30Hz iir on the loaded raws (as MotorImagery)
+    epoch      events + mne.Epochs + resample to 128Hz
+    get_data   MotorImagery.get_data() end to end
+    get_data_native  NativeMI.get_data() (NumPy epoching), same output
+    get_data_f32     NativeMI(dtype="float32"), "f32_error" = max relative
+                     error to the float64 x
+    form       Formulate.form_many() (flex2023 only)
+
+Usage:
+    python benchmark.py --subjects 1 4 --trials 16 64 --out bench.json
+    python benchmark.py --datasets flex2023 bk2019 --repeat 3 --keep /tmp/fixtures
+
+======================
+Authors: Cuong Pham
+cuongquocpham151@gmail.com
+
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import warnings
+import platform
+import tempfile
+import contextlib
+import numpy as np
+import mne
+from scipy.io import savemat, loadmat
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+for _folder in ("flex", "bk", "online"):
+    sys.path.insert(0, os.path.join(HERE, _folder))
+
+import moabb
+from moabb.paradigms import MotorImagery
+import config as flex_config
+from flex2023 import Flex2023_moabb
+from formulate import Formulate
+from epoching import NativeMI
+import bk2019
+import cho2017
+import physionet
+import bciiv2a
+
+DATASETS = ["flex2023", "bk2019", "cho2017", "physionet", "bciiv2a"]
+FS_EPOCH = 128
+
+PHYSIONET_CH = [
+    "Fc5.", "Fc3.", "Fc1.", "Fcz.", "Fc2.", "Fc4.", "Fc6.", "C5..", "C3..", "C1..",
+    "Cz..", "C2..", "C4..", "C6..", "Cp5.", "Cp3.", "Cp1.", "Cpz.", "Cp2.", "Cp4.",
+    "Cp6.", "Fp1.", "Fpz.", "Fp2.", "Af7.", "Af3.", "Afz.", "Af4.", "Af8.", "F7..",
+    "F5..", "F3..", "F1..", "Fz..", "F2..", "F4..", "F6..", "F8..", "Ft7.", "Ft8.",
+    "T7..", "T8..", "T9..", "T10.", "Tp7.", "Tp8.", "P7..", "P5..", "P3..", "P1..",
+    "Pz..", "P2..", "P4..", "P6..", "P8..", "Po7.", "Po3.", "Poz.", "Po4.", "Po8.",
+    "O1..", "Oz..", "O2..", "Iz..",
+]
+
+
+#=========================#
+## FIXTURES
+def _export_edf(fname, data, ch_names, sfreq, annotations=None):
+    info = mne.create_info(ch_names, sfreq, "eeg")
+    raw = mne.io.RawArray(data, info, verbose=False)
+    if annotations is not None:
+        raw.set_annotations(annotations)
+    with warnings.catch_warnings(): # edf precision/range notes
+        warnings.simplefilter("ignore")
+        mne.export.export_raw(fname, raw, fmt="edf", overwrite=True,
+                              physical_range="channelwise", verbose=False)
+
+
+def make_flex(root, subjects, n_trials, n_runs=2, n_extra=20, seed=0, t_end=28):
+    """
+    F<sb>_8c_ss1_run<r>.edf: EEG_CH_NAMES + MarkerValueInt + motion channels,
+    recordings end <t_end> s after the last marker
+    """
+    rng = np.random.default_rng(seed)
+    fs = flex_config.FS
+    os.makedirs(root, exist_ok=True)
+    for subject in subjects:
+        for run in range(1, n_runs+1):
+            n = fs * (14 * n_trials - 8 + t_end)
+            marker = np.zeros(n)
+            marker[fs * (6 + 14 * np.arange(n_trials))] = 1 + np.arange(n_trials) % 8
+            data = np.vstack([
+                rng.standard_normal((32, n)) * 20e-6,
+                marker * 1e-6, # read back *1e6
+                rng.standard_normal((n_extra, n)) * 1e-5,
+            ])
+            ch_names = flex_config.EEG_CH_NAMES + ["MarkerValueInt"] + \
+                [f"MOT{i}" for i in range(n_extra)]
+            _export_edf(os.path.join(root, f"F{subject}_8c_ss1_run{run}.edf"),
+                        data, ch_names, fs)
+
+
+def make_bk(root, subjects, n_trials, n_sessions=2, n_runs=2, seed=0):
+    """ [<sb>]Sub/<ss>_08/{Files/<run>.txt, Files/<run>_event.txt, trigger/<run>_trigger.csv} """
+
+    rng = np.random.default_rng(seed)
+    fs = bk2019.FS
+    delay = 5
+    for subject in subjects:
+        for session in range(n_sessions):
+            path = os.path.join(root, f"[{subject:02d}]Sub", f"{10+session}_08")
+            os.makedirs(os.path.join(path, "Files"), exist_ok=True)
+            os.makedirs(os.path.join(path, "trigger"), exist_ok=True)
+            for run in range(n_runs):
+                fn = f"BCI_Sub_{20+run:03d}I"
+                with open(os.path.join(path, "Files", f"{fn}_event.txt"), "w") as fid:
+                    fid.writelines(["-\n"] * 22 + [f"Recording delay   00:{delay:02d} -\n"])
+                secs = 8 * n_trials + 8
+                np.savetxt(os.path.join(path, "Files", f"{fn}.txt"),
+                           rng.standard_normal(((secs + delay) * fs, 7)) * 20,
+                           fmt="%.4f", header="C3 Cz C4 P3 Pz P4 ECG", comments="")
+                trig = [[1 + k % 3, 2 + 8*k, 0, 13 if k % 10 == 9 else 0] \
+                    for k in range(n_trials)]
+                np.savetxt(os.path.join(path, "trigger", f"{fn}_trigger.csv"),
+                           np.array(trig), fmt="%g", delimiter=",")
+
+
+def make_cho(root, subjects, n_trials, seed=0):
+    """ s<sb>.mat with an "eeg" struct (imagery_left/right (68, N), imagery_event, srate) """
+
+    rng = np.random.default_rng(seed)
+    fs = cho2017.FS
+    os.makedirs(root, exist_ok=True)
+    for subject in subjects:
+        n = fs * 7 * n_trials
+        event = np.zeros(n)
+        event[fs * (2 + 7 * np.arange(n_trials))] = 1
+        eeg = dict(
+            imagery_left=rng.standard_normal((68, n)) * 10 + 100,
+            imagery_right=rng.standard_normal((68, n)) * 10 - 50,
+            imagery_event=event,
+            srate=fs,
+            n_imagery_trials=n_trials,
+        )
+        savemat(os.path.join(root, f"s{subject:02d}.mat"), {"eeg": eeg})
+
+
+def make_physionet(root, subjects, n_trials, seed=0):
+    """ S<sb>/S<sb>R<run>.edf, 64 channels, T0/T1/T2 annotations """
+
+    rng = np.random.default_rng(seed)
+    fs = physionet.FS
+    runs = [4, 6, 8, 10, 12, 14]
+    for subject in subjects:
+        path = os.path.join(root, f"S{subject:03d}")
+        os.makedirs(path, exist_ok=True)
+        for run in runs:
+            onset = 8.3 * np.arange(n_trials)
+            annotations = mne.Annotations(
+                onset=np.concatenate([onset, onset + 4.15]),
+                duration=np.full(2 * n_trials, 4.1),
+                description=["T0"] * n_trials + [f"T{1 + k % 2}" for k in range(n_trials)])
+            n = int(fs * (8.3 * n_trials + 5))
+            _export_edf(os.path.join(path, f"S{subject:03d}R{run:02d}.edf"),
+                        rng.standard_normal((64, n)) * 20e-6, PHYSIONET_CH, fs, annotations)
+
+
+def make_bciiv2a(root, subjects, n_trials, n_runs=2, seed=0):
+    """ A<sb>T.mat, "data" cell of runs (X (N, 25) uV, trial, y, fs, classes) """
+
+    rng = np.random.default_rng(seed)
+    fs = 250
+    os.makedirs(root, exist_ok=True)
+    classes = np.array(["left hand", "right hand", "feet", "tongue"], dtype=object)
+    for subject in subjects:
+        runs = [dict(X=rng.standard_normal((fs * 30, 25)) * 10, trial=np.zeros(0),
+                     y=np.zeros(0), fs=fs, classes=classes, artifacts=np.zeros(0))] # baseline
+        for _ in range(n_runs):
+            trial = 1 + fs * (2 + 8 * np.arange(n_trials))
+            runs.append(dict(
+                X=rng.standard_normal((fs * (8 * n_trials + 8), 25)) * 10,
+                trial=trial, y=1 + np.arange(n_trials) % 4, fs=fs, classes=classes,
+                artifacts=np.zeros(n_trials)))
+        data = np.empty(len(runs), dtype=object)
+        data[:] = runs
+        savemat(os.path.join(root, f"A{subject:02d}T.mat"), {"data": data})
+
+
+#=========================#
+## DATASETS
+def setup(name, root, subjects, n_trials):
+    """ write fixtures of <name> under <root>, return dataset pointing at them """
+
+    path = os.path.join(root, name)
+    if name == "flex2023":
+        make_flex(path, subjects, n_trials)
+        return Flex2023_moabb(dir_raw_data=path, protocol="8c", session="ss1", run="-1")
+    elif name == "bk2019":
+        make_bk(path, subjects, n_trials)
+        bk2019.ROOT = path
+        bk2019.CACHE_DIR = os.path.join(root, "bk2019-cache")
+        bk2019._INDEX.clear()
+        dataset = bk2019.Bk2019_moabb()
+        dataset.sessions = -1
+        return dataset
+    elif name == "cho2017":
+        make_cho(path, subjects, n_trials)
+        cho2017.ROOT = path
+        return cho2017.Cho2017_moabb()
+    elif name == "physionet":
+        make_physionet(path, subjects, n_trials)
+        physionet.ROOT = path + os.sep
+        return physionet.PhysionetMI_moabb()
+    elif name == "bciiv2a":
+        make_bciiv2a(path, subjects, n_trials)
+        bciiv2a.ROOT = path
+        return bciiv2a.BCIIV2a_moabb()
+    raise ValueError(f"dataset {name} is not supported")
+
+
+def subject_ids(name, n_subjects):
+    first = 12 if name == "flex2023" else 1 # Flex2023_moabb loads F12 onwards
+    return list(range(first, first + n_subjects))
+
+
+def decode(name, dataset, subject):
+    """ native file reading only """
+
+    if name == "flex2023":
+        for edf in dataset.data_path(subject):
+            dataset._read_edf(dataset._open_edf(edf, subject))
+    elif name == "bk2019":
+        for path_session in dataset.data_path(subject).values():
+            for fn in bk2019.session_runs(path_session):
+                eeg, _ = bk2019.extract_run(path_session, fn)
+                np.asarray(eeg)
+    elif name == "cho2017":
+        loadmat(dataset.data_path(subject), squeeze_me=True, struct_as_record=False,
+                verify_compressed_data_integrity=False)["eeg"]
+    elif name == "physionet":
+        for run in dataset.hand_runs + dataset.feet_runs:
+            mne.io.read_raw_edf(dataset._load_data(subject, [run])[0],
+                                preload=True, verbose="ERROR")
+    elif name == "bciiv2a":
+        loadmat(os.path.join(bciiv2a.ROOT, f"A{subject:02d}T.mat"),
+                struct_as_record=False, squeeze_me=True)
+
+
+def discover(name, dataset, subject):
+    if name == "bciiv2a": # no data_path
+        return os.path.isfile(os.path.join(bciiv2a.ROOT, f"A{subject:02d}T.mat"))
+    if name == "bk2019":
+        bk2019._INDEX.clear()
+    elif name == "flex2023":
+        dataset._index = {}
+    return dataset.data_path(subject)
+
+
+def raws(data):
+    """ flatten {subject: {session: {run: raw}}} """
+    return [raw for sessions in data.values() for runs in sessions.values() \
+        for raw in runs.values()]
+
+
+def epoch(raw, dataset):
+    """ moabb-like epoching: stim channel events, else annotations """
+
+    stim = mne.pick_types(raw.info, eeg=False, stim=True)
+    if len(stim):
+        events = mne.find_events(raw, shortest_event=0, verbose=False)
+    else:
+        events, _ = mne.events_from_annotations(raw, event_id=dataset.event_id,
+                                                verbose=False)
+    event_id = {k: v for k, v in dataset.event_id.items() if v in events[:, 2]}
+    epochs = mne.Epochs(raw, events, event_id=event_id, tmin=dataset.interval[0],
+                        tmax=dataset.interval[1], baseline=None, proj=False,
+                        preload=True, event_repeated="drop", verbose=False)
+    return epochs.resample(FS_EPOCH)
+
+
+#=========================#
+## TIMING
+def timeit(func, repeat:int = 1, setup=None):
+    """ seconds of each of <repeat> calls of func(*setup()), last output """
+
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        with contextlib.redirect_stdout(io.StringIO()): # loaders print
+            t0 = time.perf_counter()
+            out = func(*args)
+            times.append(time.perf_counter() - t0)
+    return times, out
+
+
+def bench(name, root, n_subjects, n_trials, repeat=1):
+    """ list of {dataset, n_subjects, n_trials, stage, times, seconds} """
+
+    subjects = subject_ids(name, n_subjects)
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        dataset = setup(name, root, subjects, n_trials)
+        t_fixture = time.perf_counter() - t0
+
+    stages = {}
+    stages["discovery"], _ = timeit(
+        lambda: [discover(name, dataset, s) for s in subjects], repeat)
+    stages["decode"], _ = timeit(
+        lambda: [decode(name, dataset, s) for s in subjects], repeat)
+
+    data = {}
+    def load():
+        for s in subjects:
+            data[s] = dataset._get_single_subject_data(s)
+    stages["load"], _ = timeit(load, repeat)
+
+    list_raw = raws(data)
+    stages["filter"], _ = timeit(
+        lambda rs: [r.filter(8, 30, method="iir", picks="eeg", verbose=False) for r in rs],
+        repeat, setup=lambda: ([r.copy() for r in list_raw],))
+    stages["epoch"], _ = timeit(
+        lambda rs: [epoch(r, dataset) for r in rs],
+        repeat, setup=lambda: ([r.copy() for r in list_raw],))
+
+    events = list(dataset.event_id)
+    paradigm = MotorImagery(events=events, n_classes=len(events), fmin=8, fmax=30,
+                            resample=FS_EPOCH)
+    stages["get_data"], (x, _, _) = timeit(
+        lambda: paradigm.get_data(dataset, subjects), repeat)
+    native = NativeMI(events=events, n_classes=len(events), fmin=8, fmax=30,
+                      resample=FS_EPOCH)
+    stages["get_data_native"], (x64, _, _) = timeit(
+        lambda: native.get_data(dataset, subjects), repeat)
+    native.dtype = "float32"
+    stages["get_data_f32"], (x32, _, _) = timeit(
+        lambda: native.get_data(dataset, subjects), repeat)
+    f32_error = float(np.abs(x32 - x64).max() / np.abs(x64).max())
+
+    if name == "flex2023":
+        stages["form"], _ = timeit(
+            lambda: [Formulate(dataset, subject=s).form_many(["4c_all", "8c_mi", "8c_rest"]) \
+                for s in subjects], repeat)
+
+    n_samples = int(sum(r.n_times for r in list_raw))
+    return [dict(dataset=name, n_subjects=n_subjects, n_trials=n_trials,
+                 n_runs=len(list_raw), n_samples=n_samples, n_epochs=len(x),
+                 fixture=t_fixture, f32_error=f32_error,
+                 stage=stage, times=times, seconds=min(times)) \
+                for stage, times in stages.items()]
+
+
+#=========================#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--datasets", nargs="+", default=DATASETS, choices=DATASETS)
+    parser.add_argument("--subjects", nargs="+", type=int, default=[1, 2],
+                        help="subject counts")
+    parser.add_argument("--trials", nargs="+", type=int, default=[16, 48],
+                        help="trials per run (record length)")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--keep", default=None, help="folder to keep fixtures in")
+    args = parser.parse_args(argv)
+
+    mne.set_log_level("ERROR")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.datasets:
+            for n_subjects in args.subjects:
+                for n_trials in args.trials:
+                    root = os.path.join(args.keep or tmp, f"s{n_subjects}_t{n_trials}")
+                    try:
+                        res = bench(name, root, n_subjects, n_trials, args.repeat)
+                    except Exception as e: # record, keep benchmarking the others
+                        res = [dict(dataset=name, n_subjects=n_subjects, n_trials=n_trials,
+                                    stage="error", error=repr(e))]
+                    for r in res:
+                        print(f"{r['dataset']:>10} | sb={r['n_subjects']} trials={r['n_trials']} "
+                              f"| {r['stage']:>15} | " + \
+                              (f"{r['seconds']:.3f}s" if "seconds" in r else r["error"]))
+                    results += res
+
+    out = dict(
+        created=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        platform=platform.platform(),
+        python=platform.python_version(),
+        versions=dict(numpy=np.__version__, mne=mne.__version__, moabb=moabb.__version__),
+        args=vars(args),
+        results=results,
+    )
+    with open(args.out, "w") as fid:
+        json.dump(out, fid, indent=1)
+    return out
+
+
+if __name__ == "__main__":
+    main()
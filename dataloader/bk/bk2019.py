@@ -14,11 +14,19 @@ cuongquocpham151@gmail.com
 
 """
 import os
+import sys
+import shutil
 import numpy as np
 import pandas as pd
 import mne
+from joblib import Parallel, delayed
 from mne.channels import make_standard_montage
 from moabb.datasets.base import BaseDataset
+for _folder in ("flex", "online"): # shared helpers
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", _folder))
+from instrument import instrumented
+from tree_index import update_index
+from decimate import decimate_time, decimate_stim
 
 
 #=========================#
@@ -28,6 +36,65 @@ FS = 500
 LIST_SUBJECTS = list(range(1,13))
 ALL_EVENTS = dict(right_hand=2, left_hand=1, feet=3)
 EEG_CH_NAMES = ['C3', 'Cz', 'C4', 'P3', 'Pz', 'P4']
+# folder of derived files (binary copies of Files/*.txt, event tables), kept
+# out of ROOT so the source files of a subject (cache.source_files) stay the
+# same. None: next to the txt files
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "bk2019")
+CHUNK_ROWS = 2**16
+INDEX_FILE = ".bk2019_index.json" # manifest of ROOT, see get_index()
+EVENTS_FILE = ".bk2019_events.npz" # event table of a session, see session_events()
+EVENT_DTYPE = np.dtype([
+    ("run", "<u2"),   # index in session_runs()
+    ("onset", "<i8"), # sample after the recording delay
+    ("label", "<i2"),
+    ("flag", "<i2"),  # 4th trigger column (13: skipped), 0 if none
+])
+RUN_OK, RUN_BAD_DELAY, RUN_BAD_TRIGGER = 0, 1, 2
+
+
+#=========================#
+_INDEX = {}
+
+def get_index(refresh:bool = False) -> dict:
+    """
+    Return manifest of ROOT, built once and stored in ROOT/INDEX_FILE
+        {
+            "tree": scan_tree(ROOT),
+            "subjects": {"1": {"0": ../[01]DucMinh/10_08}},
+            "runs": {../[01]DucMinh/10_08: ["BCI_Minh_023I", ...]},
+        }
+    Later processes only re-list folders whose mtime changed.
+    """
+    if _INDEX and not refresh:
+        return _INDEX
+
+    def sortDates(datesList):
+        split_up = datesList.split('_')
+        return split_up[0], split_up[1]
+
+    def build(tree):
+        subjects, runs = {}, {}
+        for fol_sb in tree[ROOT]["dirs"]:
+            path_sb = os.path.join(ROOT, fol_sb)
+            list_ss = [i for i in tree[path_sb]["dirs"] if i!="all"]
+            list_ss_sort = sorted(list_ss, key=sortDates)
+
+            subjects[str(int(fol_sb[1:3]))] = {
+                str(i): os.path.join(path_sb, v) for i,v in enumerate(list_ss_sort)
+            }
+            for path_session in subjects[str(int(fol_sb[1:3]))].values():
+                runs[path_session] = sorted(
+                    file.split("_event")[0] # BCI_Minh_023I
+                    for folder, entry in tree.items() \
+                        if folder.startswith(path_session + os.sep) or folder == path_session
+                    for file in entry["files"] if "I_event" in file
+                )
+        return dict(subjects=subjects, runs=runs)
+
+    index = update_index(ROOT, os.path.join(ROOT, INDEX_FILE), build)
+    _INDEX.clear()
+    _INDEX.update(index)
+    return _INDEX
 
 
 #=========================#
@@ -40,94 +107,255 @@ def structurize_folder():
             }
         }
     """
-    def sortDates(datesList):
-        split_up = datesList.split('_')
-        return split_up[0], split_up[1]
+    return {int(k): v for k,v in get_index()["subjects"].items()}
+
+
+#=========================#
+def convert_txt(file_data:str, file_npy:str):
+    """
+    Convert recording <file_data> (N, 7) txt into float32 <file_npy>,
+    parsing CHUNK_ROWS rows at a time with the pandas C parser (never
+    holds the full table).
+    """
+    tmp = f"{file_npy}.tmp{os.getpid()}"
+    n_rows, n_cols = 0, 0
+    reader = pd.read_csv(file_data, sep=r"\s+", header=None, skiprows=1,
+                         dtype=np.float32, engine="c", chunksize=CHUNK_ROWS)
+    with reader, open(tmp + ".raw", "wb") as fout:
+        for chunk in reader:
+            chunk = chunk.to_numpy(dtype="<f4")
+            n_rows += chunk.shape[0]
+            n_cols = chunk.shape[1]
+            fout.write(chunk.tobytes())
+
+    # .npy = header + raw rows
+    with open(tmp, "wb") as fout, open(tmp + ".raw", "rb") as fraw:
+        np.lib.format.write_array_header_1_0(fout, dict(
+            descr="<f4", fortran_order=False, shape=(n_rows, n_cols)))
+        shutil.copyfileobj(fraw, fout)
+    os.remove(tmp + ".raw")
+    os.replace(tmp, file_npy)
+
+
+#=========================#
+def load_txt(file_data:str):
+    """
+    Return recording <file_data> as a memory-mapped float32 (N, 7) array.
+    The txt is converted once to a binary .npy (in CACHE_DIR or next to
+    the txt) and reconverted only if the txt is newer.
+    """
+    if CACHE_DIR is None:
+        file_npy = os.path.splitext(file_data)[0] + ".npy"
+    else:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        name = os.path.relpath(file_data, ROOT).replace(os.sep, "__")
+        file_npy = os.path.join(CACHE_DIR, os.path.splitext(name)[0] + ".npy")
+
+    if not os.path.isfile(file_npy) or \
+        os.path.getmtime(file_npy) < os.path.getmtime(file_data):
+        convert_txt(file_data, file_npy)
+
+    return np.load(file_npy, mmap_mode="r")
+
+
+#=========================#
+def session_runs(path_session:str = ""):
+    """ return sorted run prefixes (BCI_Minh_023I) of a session """
+
+    list_runs = get_index()["runs"].get(path_session)
+    if list_runs is None: # session outside ROOT
+        list_runs = []
+        for root, dirs, files in os.walk(path_session):
+            for file in files:
+                if "I_event" in file:
+                    prefix = file.split("_event")[0] # BCI_Minh_023I
+                    list_runs.append(prefix)
+        list_runs.sort(reverse=False)
+    return list_runs
+
+
+#=========================#
+def parse_delay(file_delay:str) -> int:
+    """ recording delay (s) from line 22 of a <fn>_event.txt """
+
+    with open(file_delay, 'r') as fid:
+        txt = fid.readlines()
+    mins = txt[22][18:20]
+    secs = txt[22][21:23]
+    return int(mins) * 60 + int(secs)
+
+
+#=========================#
+def parse_trigger(file_trigger:str, run:int) -> np.ndarray:
+    """ EVENT_DTYPE records of a <fn>_trigger.csv (label, time (s)[, ., flag]) """
 
-    d = {}
-    for fol_sb in os.listdir(ROOT):
-        list_ss = [i for i in os.listdir(ROOT+"/"+fol_sb) if i!="all"]
-        list_ss_sort = sorted(list_ss, key=sortDates)
+    check = pd.read_csv(file_trigger, header=None).to_numpy()
+    events = np.zeros(check.shape[0], dtype=EVENT_DTYPE)
+    events["run"] = run
+    events["onset"] = (check[:, 1] * FS).astype(np.int64)
+    events["label"] = check[:, 0]
+    if check.shape[1] > 3:
+        events["flag"] = check[:, 3]
+    return events
 
-        d[int(fol_sb[1:3])] = {
-            str(i): os.path.join(ROOT, fol_sb, v) \
-                for i,v in enumerate(list_ss_sort)
+
+#=========================#
+_EVENTS = {} # {path_session: session_events()}
+
+def session_events(path_session:str, refresh:bool = False) -> dict:
+    """
+    Return event table of a session, parsed once from all its delay and
+    trigger files and cached in memory and in <path_session>/EVENTS_FILE
+    (or CACHE_DIR), until one of these files changes.
+        {
+            "runs": ["BCI_Minh_023I", ...],     # session_runs()
+            "delays": (n_runs,) int, delay (s), -1 if broken
+            "status": (n_runs,) int, RUN_OK / RUN_BAD_DELAY / RUN_BAD_TRIGGER
+            "events": EVENT_DTYPE (n_events,), ordered by run
         }
-    return d
+    """
+    runs = session_runs(path_session)
+    files = [os.path.join(path_session, "Files", f"{fn}_event.txt") for fn in runs] + \
+        [os.path.join(path_session, "trigger", f"{fn}_trigger.csv") for fn in runs]
+    stamp = np.array([os.stat(i).st_mtime_ns if os.path.isfile(i) else -1 for i in files],
+                     dtype=np.int64)
+
+    table = _EVENTS.get(path_session)
+    if not refresh and table is not None and table["runs"] == runs and \
+        np.array_equal(table["stamp"], stamp):
+        return table
+
+    if CACHE_DIR is None:
+        file_events = os.path.join(path_session, EVENTS_FILE)
+    else:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        name = os.path.relpath(path_session, ROOT).replace(os.sep, "__")
+        file_events = os.path.join(CACHE_DIR, f"{name}{EVENTS_FILE}")
+    try:
+        with np.load(file_events) as f:
+            table = dict(runs=f["runs"].tolist(), stamp=f["stamp"], delays=f["delays"],
+                         status=f["status"], events=f["events"])
+    except (OSError, ValueError, KeyError):
+        table = None
+
+    if refresh or table is None or table["runs"] != runs or \
+        not np.array_equal(table["stamp"], stamp):
+        delays = np.full(len(runs), -1, dtype=np.int64)
+        status = np.full(len(runs), RUN_OK, dtype=np.int8)
+        events = []
+        for run, fn in enumerate(runs):
+            try:
+                delays[run] = parse_delay(os.path.join(path_session, "Files", f"{fn}_event.txt"))
+            except Exception:
+                status[run] = RUN_BAD_DELAY
+                continue
+            try:
+                events.append(parse_trigger(
+                    os.path.join(path_session, "trigger", f"{fn}_trigger.csv"), run))
+            except Exception:
+                status[run] = RUN_BAD_TRIGGER
+        events = np.concatenate(events) if events else np.zeros(0, dtype=EVENT_DTYPE)
+        table = dict(runs=runs, stamp=stamp, delays=delays, status=status, events=events)
+
+        try:
+            os.makedirs(os.path.dirname(file_events), exist_ok=True)
+            tmp = f"{file_events}.tmp{os.getpid()}.npz"
+            np.savez(tmp, runs=np.array(runs, dtype=str), stamp=stamp, delays=delays,
+                     status=status, events=events)
+            os.replace(tmp, file_events)
+        except OSError: # read-only dataset, keep in memory
+            pass
+
+    _EVENTS[path_session] = table
+    return table
+
+
+#=========================#
+def run_events(path_session:str, fn:str):
+    """
+    Return (delay (s), events (n, 3) [onset sample, 0, label]) of run <fn>,
+    triggers flagged 13 excluded. None if its delay/trigger file is broken.
+    The events can be passed directly to mne.Epochs instead of a stim channel.
+    """
+    table = session_events(path_session)
+    run = table["runs"].index(fn)
+    if table["status"][run] == RUN_BAD_DELAY:
+        print(f"[ERROR] file_delay | {os.path.join(path_session, 'Files', f'{fn}_event.txt')}")
+        return None
+    if table["status"][run] == RUN_BAD_TRIGGER:
+        print(f"[ERROR] events | {os.path.join(path_session, 'trigger', f'{fn}_trigger.csv')}")
+        return None
+
+    ev = table["events"][table["events"]["run"] == run]
+    ev = ev[ev["flag"] != 13]
+    events = np.zeros((len(ev), 3), dtype=np.int64)
+    events[:, 0] = ev["onset"]
+    events[:, 2] = ev["label"]
+    return int(table["delays"][run]), events
+
+
+#=========================#
+def extract_run(path_session:str, fn:str, stim:bool = True):
+    """
+    extract eeg and events of run <fn>, None if its files are broken.
+    Return (eeg (N, 6), stim (N,)), or (eeg, events (n, 3)) if not <stim>.
+    """
+    res = run_events(path_session, fn)
+    if res is None:
+        return None
+    delay, events = res
+
+    ## load file
+    try:
+        file_data = os.path.join(path_session, "Files", f"{fn}.txt")
+        s = load_txt(file_data) # (N, 7) memmap
+        eeg = s[FS*delay:, :6] # exclude ECG
+    except:
+        print(f"[ERROR] file_data | {file_data}")
+        return None
+
+    if (events[:, 0] >= eeg.shape[0]).any(): # trigger after the recording
+        print(f"[ERROR] events | {os.path.join(path_session, 'trigger', f'{fn}_trigger.csv')}")
+        return None
+    if not stim:
+        return eeg, events
+
+    ## stim channel, later triggers win on the same sample
+    out = np.zeros(eeg.shape[0], dtype=np.int16)
+    out[events[:, 0]] = events[:, 2]
+    return eeg, out
 
 
 #=========================#
-def extract_session(path_session:str = ""):
+def extract_session(path_session:str = "", n_jobs:int = 1):
     """ extract eeg and events for each session """
 
-    list_runs = []
-    for root, dirs, files in os.walk(path_session):
-        for file in files:
-            if "I_event" in file:
-                prefix = file.split("_event")[0] # BCI_Minh_023I
-                list_runs.append(prefix)
-    list_runs.sort(reverse=False)
+    list_runs = session_runs(path_session)
     # print(list_runs)
 
+    out = Parallel(n_jobs=n_jobs)(
+        delayed(extract_run)(path_session, fn) for fn in list_runs)
+
     d_eeg = {}
     d_stim = {}
+    for run, res in enumerate(out):
+        if res is not None:
+            d_eeg[str(run)], d_stim[str(run)] = res
 
-    for run, fn in enumerate(list_runs):
-
-        ## check delay
-        try:
-            file_delay = os.path.join(path_session, "Files", f"{fn}_event.txt")
-            with open(file_delay, 'r') as fid:
-                txt = fid.readlines()
-            mins = txt[22][18:20]
-            secs = txt[22][21:23]
-            delay = int(mins) * 60 + int(secs)
-            # print(mins, secs, delay)
-        except:
-            print(f"[ERROR] file_delay | {file_delay}")
-            continue
-
-        ## load file
-        try:
-            file_data = os.path.join(path_session, "Files", f"{fn}.txt")
-            s = np.loadtxt(file_data, skiprows=1) # (N, 7)
-            eeg = s[FS*delay:, :6] # exclude ECG
-            # print(eeg.shape)
-        except:
-            print(f"[ERROR] file_data | {file_data}")
-            continue
-
-        ## labels & create events
-        try:
-            file_trigger = os.path.join(path_session, "trigger", f"{fn}_trigger.csv")
-            check = pd.read_csv(file_trigger, header=None).to_numpy()
-
-            stim = [0]*eeg.shape[0]
-            for j in range(check.shape[0]):
-                if check.shape[1] > 3 and check[j,3] == 13:
-                    continue
-                else:
-                    mi_start = int(check[j, 1] * FS)
-                    lb = check[j, 0]
-                    stim[mi_start] = lb
-        except:
-            print(f"[ERROR] events | {file_trigger}")
-            continue
-
-        d_eeg[str(run)] = eeg
-        d_stim[str(run)] = stim
-
-    
     return d_eeg, d_stim
-        
+
 
 
 #=========================#
 class Bk2019_moabb(BaseDataset):
     """Motor Imagery dataset
+    Args:
+        n_jobs (int): number of processes loading runs. Defaults to 1.
+        fs_resample (int): sampling rate to decimate to while loading
+            (e.g. 500->128). Defaults to None (keep FS).
     """
 
-    def __init__(self):
+    def __init__(self, n_jobs:int = 1, fs_resample:int = None):
         super().__init__(
             subjects=LIST_SUBJECTS,
             sessions_per_subject=5,
@@ -140,16 +368,46 @@ class Bk2019_moabb(BaseDataset):
         
         self.sessions = 0
         self.runs = -1
+        self.n_jobs = n_jobs
+        self.fs_resample = fs_resample
+
+    def _load_run(self, path_session, fn):
+        """Return raw of one run, None if its files are broken"""
+
+        res = extract_run(path_session, fn)
+        if res is None:
+            return None
+        eeg, stim = res
+        eeg = eeg.T # (6, N)
+        sfreq = FS
+        if self.fs_resample is not None:
+            eeg = decimate_time(eeg, FS, self.fs_resample) # 6 rows, chunk along time
+            stim = decimate_stim(stim, FS, self.fs_resample)
+            sfreq = self.fs_resample
 
-    def _get_single_subject_data(self, subject):
-        """Return data for a single subject."""
-    
         # fmt: off
         ch_types = ["eeg"]*6 + ["stim"]
         ch_names = EEG_CH_NAMES + ["Stim"]
-        info = mne.create_info(ch_names=ch_names, ch_types=ch_types, sfreq=FS)
+        info = mne.create_info(ch_names=ch_names, ch_types=ch_types, sfreq=sfreq)
         montage = make_standard_montage("standard_1020")
 
+        # eeg (6, N) + stim (1, N) written into one (7,N) buffer
+        data = np.empty((len(ch_names), eeg.shape[1]))
+        data[:6] = eeg
+        data[6] = stim
+
+        # a,b=np.unique(stim, return_counts=True)
+        # print([(i,v) for i,v in zip(a, b)])
+
+        raw = mne.io.RawArray(data=data, info=info, verbose=False)
+        raw.set_montage(montage)
+        return raw
+
+    @instrumented("bk2019._get_single_subject_data",
+                  lambda self, subject: dict(subject=subject))
+    def _get_single_subject_data(self, subject):
+        """Return data for a single subject."""
+
         ## read raw
         d_ss_path = self.data_path(subject)
         # print(d_ss_path)
@@ -161,28 +419,24 @@ class Bk2019_moabb(BaseDataset):
             list_sessions = d_ss_path.keys()
 
         ## check chosen run
-        if self.runs != -1: 
-            list_runs = [str(self.runs)]
-        else:
-            list_runs = d_stim.keys()
-
-
-        sessions = {}
+        tasks = [] # (session_idx, run, path_session, fn)
         for session_idx in list_sessions:
-            d_eeg, d_stim = extract_session(d_ss_path[session_idx])
-  
-            sessions[session_idx] = {}
-            for run in list_runs:
-                eeg = d_eeg[run].T # (6, N)
-                stim = np.array(d_stim[run]).reshape(1,-1) # (1, N)
-                data = np.vstack([eeg, stim]) # (7,N)
-
-                # a,b=np.unique(stim, return_counts=True)
-                # print([(i,v) for i,v in zip(a, b)])
-
-                raw = mne.io.RawArray(data=data, info=info, verbose=False)
-                raw.set_montage(montage)
+            path_session = d_ss_path[session_idx]
+            list_runs = list(enumerate(session_runs(path_session)))
+            if self.runs != -1: 
+                list_runs = [list_runs[self.runs]]
+            tasks += [(session_idx, str(run), path_session, fn) \
+                for run, fn in list_runs]
+
+        ## load runs of all sessions together, merge in order
+        list_raw = Parallel(n_jobs=self.n_jobs)(
+            delayed(self._load_run)(path_session, fn) \
+                for (_, _, path_session, fn) in tasks)
 
+        sessions = {}
+        for (session_idx, run, _, _), raw in zip(tasks, list_raw):
+            sessions.setdefault(session_idx, {})
+            if raw is not None:
                 sessions[session_idx][run] = raw
         
         # a = sessions["0"]["0"]
@@ -194,6 +448,7 @@ class Bk2019_moabb(BaseDataset):
         return sessions
 
 
+    @instrumented("bk2019.data_path", lambda self, subject, *args, **kwargs: dict(subject=subject))
     def data_path(self, subject, path=None, force_update=False, update_path=None, verbose=None):
         d = structurize_folder()
         return d[subject]
@@ -0,0 +1,221 @@
+"""
+On-disk epoch cache for Formulate
+
+======================
+Authors: Cuong Pham
+cuongquocpham151@gmail.com
+
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+
+
+#=========================#
+def source_files(dataset, subject):
+    """
+    Return sorted list of (path, size, mtime) of the files behind <subject>.
+    Hidden files (loader indexes, event tables) are skipped, they are
+    derived from the others.
+    """
+
+    try:
+        paths = dataset.data_path(subject)
+    except TypeError: # e.g. BCIIV2a_moabb.data_path() takes no subject
+        paths = None
+
+    def flatten(p):
+        if isinstance(p, dict):
+            return [j for i in p.values() for j in flatten(i)]
+        elif isinstance(p, (list, tuple)):
+            return [j for i in p for j in flatten(i)]
+        elif isinstance(p, str):
+            return [p]
+        return []
+
+    files = []
+    for p in flatten(paths):
+        if os.path.isdir(p):
+            for root, dirs, fns in os.walk(p):
+                dirs[:] = [i for i in dirs if not i.startswith(".")]
+                files += [os.path.join(root, fn) for fn in fns if not fn.startswith(".")]
+        else:
+            files.append(p)
+
+    out = []
+    for p in sorted(set(files)):
+        try:
+            st = os.stat(p)
+            out.append((p, st.st_size, st.st_mtime_ns))
+        except OSError:
+            out.append((p, -1, -1))
+    return out
+
+
+# loader settings that change how, not what, data is read
+EXECUTION_ONLY = ("n_jobs", "prefetch", "preallocate")
+
+
+#=========================#
+def dataset_state(dataset):
+    """
+    Return public settings of <dataset> (protocol, session, run, ...),
+    execution-only ones (EXECUTION_ONLY) left out
+    """
+
+    return {k: v for k, v in sorted(vars(dataset).items()) \
+        if not k.startswith("_") and k not in EXECUTION_ONLY and \
+            isinstance(v, (str, int, float, bool, list, tuple, dict, type(None)))}
+
+
+#=========================#
+class EpochCache():
+    """
+    Content-addressed cache of extracted epochs (x, y, metadata).
+    Each entry is a folder <root>/<key> with x.npy, y.npy, metadata.npy
+    (memory-mappable) and meta.json. Least recently used entries are
+    removed once the cache grows over <max_bytes>. Hits are memory-mapped
+    copy-on-write (<mmap_mode>="c"), writable like the arrays of a miss.
+
+    Usage:
+        cache = EpochCache("/home/pham/bci/CACHE", max_bytes=20e9)
+        f = Formulate(dataset, subject=1, cache=cache)
+        x, y, le = f.form("4c_all")
+        print(cache.stats)
+    """
+    def __init__(
+        self,
+        root:str = ".epoch_cache",
+        max_bytes:float = 10e9,
+        mmap_mode:str = "c",
+    ):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.mmap_mode = mmap_mode
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0.0 # (s)
+        os.makedirs(self.root, exist_ok=True)
+
+    def key(self, dataset, subject, **params) -> str:
+        """ Hash of source files, dataset class/settings, subject and <params> """
+
+        desc = dict(
+            files=source_files(dataset, subject),
+            dataset=type(dataset).__name__,
+            state=dataset_state(dataset),
+            subject=subject,
+            params=params,
+        )
+        txt = json.dumps(desc, sort_keys=True, default=str)
+        return hashlib.sha1(txt.encode()).hexdigest()
+
+    def get(self, key:str):
+        """ Return (x, y, metadata) or None """
+
+        path = os.path.join(self.root, key)
+        try:
+            t0 = time.perf_counter()
+            x = np.load(os.path.join(path, "x.npy"), mmap_mode=self.mmap_mode)
+            y = np.load(os.path.join(path, "y.npy"))
+            metadata = np.load(os.path.join(path, "metadata.npy"),
+                               mmap_mode=self.mmap_mode)
+            with open(os.path.join(path, "meta.json"), "r") as fid:
+                meta = json.load(fid)
+            os.utime(os.path.join(path, "meta.json")) # LRU
+        except (OSError, ValueError):
+            return None
+
+        self.hits += 1
+        self.time_saved += meta["elapsed"] - (time.perf_counter() - t0)
+        return x, y, metadata
+
+    def put(self, key:str, x, y, metadata, elapsed:float=0.0) -> None:
+        """ Store an entry, then evict LRU entries over budget """
+
+        path = os.path.join(self.root, key)
+        tmp = f"{path}.tmp{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+        np.save(os.path.join(tmp, "x.npy"), np.asarray(x))
+        np.save(os.path.join(tmp, "y.npy"), np.asarray(y, dtype=str))
+        np.save(os.path.join(tmp, "metadata.npy"), to_records(metadata))
+        with open(os.path.join(tmp, "meta.json"), "w") as fid:
+            json.dump(dict(elapsed=elapsed, created=time.time()), fid)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+        self.evict()
+
+    def get_or_extract(self, key:str, extract):
+        """ Return cached (x, y, metadata), or run <extract>() and store it """
+
+        out = self.get(key)
+        if out is not None:
+            return out
+
+        self.misses += 1
+        t0 = time.perf_counter()
+        x, y, metadata = extract()
+        self.put(key, x, y, metadata, elapsed=time.perf_counter()-t0)
+        return x, y, metadata
+
+    def entries(self) -> list:
+        """ Return list of (last_used, size, path), oldest first """
+
+        out = []
+        for key in os.listdir(self.root):
+            path = os.path.join(self.root, key)
+            try:
+                last_used = os.stat(os.path.join(path, "meta.json")).st_mtime
+            except OSError:
+                continue # unfinished/foreign folder
+            size = sum(os.path.getsize(os.path.join(path, fn)) \
+                for fn in os.listdir(path))
+            out.append((last_used, size, path))
+        return sorted(out)
+
+    def evict(self) -> None:
+        """ Remove least recently used entries until size <= max_bytes """
+
+        entries = self.entries()
+        total = sum(i[1] for i in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self) -> None:
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+    @property
+    def stats(self) -> dict:
+        entries = self.entries()
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            time_saved=self.time_saved,
+            n_entries=len(entries),
+            n_bytes=sum(i[1] for i in entries),
+        )
+
+
+#=========================#
+def to_records(metadata):
+    """ MOABB metadata (DataFrame) -> numpy record array with fixed-width str """
+
+    if metadata is None:
+        return np.zeros(0)
+    if hasattr(metadata, "to_records"):
+        metadata = metadata.to_records(index=False)
+    metadata = np.asarray(metadata)
+    if metadata.dtype.names is None:
+        return metadata
+    return np.rec.fromarrays(
+        [np.asarray(metadata[i], dtype=str) if metadata.dtype[i] == object \
+            else metadata[i] for i in metadata.dtype.names],
+        names=metadata.dtype.names)
@@ -0,0 +1,208 @@
+"""
+Native NumPy epoching for Formulate (no mne.Epochs)
+
+======================
+Authors: Cuong Pham
+cuongquocpham151@gmail.com
+
+"""
+import numpy as np
+import pandas as pd
+import mne
+from numpy.lib.stride_tricks import sliding_window_view
+from moabb.paradigms import MotorImagery
+from filterbank import filter_bank
+
+
+#=========================#
+def find_stim_events(stim) -> np.ndarray:
+    """
+    Onsets of <stim> (N,) as mne.find_events(shortest_event=0) does:
+    samples (after the first) where the value increases to a nonzero code
+    -> events (n, 3) [sample, previous value, code]
+    """
+    stim = np.asarray(stim)
+    idx = np.flatnonzero(np.diff(stim) > 0) + 1
+    idx = idx[stim[idx] > 0]
+    return np.column_stack([idx, stim[idx-1], stim[idx]]).astype(np.int64)
+
+
+#=========================#
+def raw_events(raw, event_id:dict) -> np.ndarray:
+    """ events (n, 3) of <raw> (sample from first_samp), stim channel else annotations """
+
+    stim = mne.pick_types(raw.info, eeg=False, stim=True)
+    if len(stim):
+        events = find_stim_events(raw.get_data(picks=stim[:1])[0])
+    else:
+        try:
+            events, _ = mne.events_from_annotations(raw, event_id=event_id, verbose=False)
+        except ValueError: # none of event_id
+            return np.zeros((0, 3), dtype=np.int64)
+        events[:, 0] -= raw.first_samp
+    events = events[np.isin(events[:, 2], list(event_id.values()))]
+
+    # event_repeated="drop": keep the first event of a sample
+    _, first = np.unique(events[:, 0], return_index=True)
+    return events[np.sort(first)]
+
+
+#=========================#
+def bad_spans(raw) -> np.ndarray:
+    """ (onset, offset) (s, from first_samp) of the "bad*" annotations of <raw> """
+
+    annot = raw.annotations
+    keep = np.array([d.lower().startswith("bad") for d in annot.description], dtype=bool)
+    if not keep.any():
+        return np.zeros((0, 2))
+    # onsets count from meas_date (annotations are synced to it on
+    # set_annotations), first_time is where the samples of <raw> start
+    assert annot.orig_time == raw.info["meas_date"]
+    onset = annot.onset[keep] - raw.first_time
+    return np.column_stack([onset, onset + annot.duration[keep]])
+
+
+#=========================#
+def kept_events(samples, n_raw:int, sfreq:float, bads, tmin:float, tmax:float):
+    """
+    Which events at <samples> an epoching over [<tmin>, <tmax>] (s) keeps,
+    as mne.Epochs (reject_by_annotation): inside the <n_raw> samples and
+    off the <bads> spans (see bad_spans)
+    -> starts (n,) of the epochs, mask (n,)
+    """
+    first = int(round(tmin * sfreq))
+    n_times = int(round(tmax * sfreq)) - first + 1
+    starts = samples + first
+    ok = (starts >= 0) & (starts + n_times <= n_raw)
+    if len(bads):
+        ok &= ~((bads[None, :, 0] < (starts + n_times)[:, None] / sfreq) & \
+                (bads[None, :, 1] > starts[:, None] / sfreq)).any(axis=1)
+    return starts, ok
+
+
+#=========================#
+def run_events(dataset, subject:int, event_id:dict) -> list:
+    """
+    (samples, n_times, sfreq, bads) of each run of <subject>, enough to tell
+    which events an epoching keeps (kept_events) without filtering/epoching
+    """
+    out = []
+    for sessions in dataset.get_data([subject]).values():
+        for runs in sessions.values():
+            for raw in runs.values():
+                out.append((raw_events(raw, event_id)[:, 0], raw.n_times,
+                            raw.info["sfreq"], bad_spans(raw)))
+    return out
+
+
+#=========================#
+def gather(data, starts, n_times:int, dtype=None) -> np.ndarray:
+    """ (channels, N) -> contiguous (trials, channels, n_times) at <starts> """
+
+    windows = sliding_window_view(data, n_times, axis=-1) # (channels, N-n+1, n_times), no copy
+    return np.ascontiguousarray(windows[:, starts].transpose(1, 0, 2), dtype=dtype)
+
+
+#=========================#
+def resample_epochs(x, sfreq:float, resample:float = None) -> np.ndarray:
+    """
+    Resample epochs <x> (trials, channels, times[, bands]) from <sfreq> to
+    <resample> as mne.Epochs.resample (moabb resample step), same dtype
+    """
+    if resample is None or not len(x) or float(resample) == float(sfreq):
+        return x
+    # mne resamples float64 only
+    return mne.filter.resample(x.astype(np.float64, copy=False), float(resample), float(sfreq),
+                               npad="auto", window="auto", pad="edge", method="fft",
+                               axis=2).astype(x.dtype, copy=False)
+
+
+#=========================#
+def epoch_raw(raw, event_id:dict, tmin:float, tmax:float, channels=None,
+              bands=None, resample=None, dtype=None):
+    """
+    Epoch one raw like moabb RawToEpochs (+ bandpass iir before, resample after)
+    <tmin>/<tmax> are relative to the events (s). Return x (trials,
+    channels, times[, bands]) in raw units and event codes (trials,).
+    <dtype> (e.g. float32) is used from filtering on, see filter_bank().
+    """
+    sfreq = raw.info["sfreq"]
+    events = raw_events(raw, event_id)
+
+    n_times = int(round(tmax * sfreq)) - int(round(tmin * sfreq)) + 1
+    starts, ok = kept_events(events[:, 0], raw.n_times, sfreq, bad_spans(raw), tmin, tmax)
+    starts, codes = starts[ok], events[ok, 2]
+
+    if channels is None:
+        picks = mne.pick_types(raw.info, eeg=True, stim=False)
+    else:
+        picks = [raw.ch_names.index(ch) for ch in channels]
+    data = raw.get_data(picks=picks)
+
+    if bands is None:
+        x = gather(data, starts, n_times, dtype)[..., None]
+    else:
+        # filter only the picked channels, same iir as raw.filter(method="iir")
+        filtered = filter_bank(data, sfreq, bands, dtype=dtype)
+        del data
+        x = np.stack([gather(i, starts, n_times) for i in filtered], axis=-1)
+
+    return resample_epochs(x, sfreq, resample), codes
+
+
+################################
+class NativeMI(MotorImagery):
+    """
+    MotorImagery / FilterBankMotorImagery with a NumPy get_data():
+    events are found on the stim channel (or annotations), only the
+    <channels> are filtered, and all trials are gathered at once from the
+    continuous data, without mne.Epochs / per-run pipelines. Same x, y and
+    metadata columns as moabb (x * dataset.unit_factor).
+    <dtype>="float32" filters, epochs and returns float32 x (within
+    filterbank.FLOAT32_RTOL of the float64 output).
+
+    Usage:
+        paradigm = NativeMI(events=["left_hand", "right_hand"], n_classes=2,
+                            fmin=8, fmax=13, tmin=0, tmax=2,
+                            channels=("C3", "Cz", "C4"), resample=128)
+        x, y, metadata = paradigm.get_data(dataset=dataset, subjects=[12])
+    """
+    def __init__(self, filters=None, dtype=None, **kwargs):
+        if filters is not None:
+            kwargs.update(fmin=filters[0][0], fmax=filters[0][1])
+        super().__init__(**kwargs)
+        self.bands = None if filters is None else [list(band) for band in filters]
+        self.dtype = dtype
+
+    def get_data(self, dataset, subjects=None, return_epochs=False, **kwargs):
+        if return_epochs or kwargs.get("return_raws"):
+            raise ValueError("NativeMI only returns arrays")
+        if subjects is None:
+            subjects = dataset.subject_list
+
+        event_id = self.used_events(dataset)
+        names = {v: k for k, v in event_id.items()}
+        bands = self.bands or [list(band) for band in self.filters]
+        if bands == [[None, None]]:
+            bands = None
+        tmin = self.tmin + dataset.interval[0]
+        tmax = dataset.interval[1] if self.tmax is None else self.tmax + dataset.interval[0]
+
+        xs, ys, meta = [], [], []
+        for subject, sessions in dataset.get_data(subjects).items():
+            for session, runs in sessions.items():
+                for run, raw in runs.items():
+                    x, codes = epoch_raw(raw, event_id, tmin, tmax, self.channels,
+                                         bands, self.resample, self.dtype)
+                    if not len(codes):
+                        continue
+                    xs.append(x)
+                    ys += [names[i] for i in codes]
+                    meta += [(subject, session, run)] * len(codes)
+
+        x = np.concatenate(xs)
+        x *= dataset.unit_factor
+        if self.bands is None:
+            x = x[..., 0]
+        metadata = pd.DataFrame(meta, columns=["subject", "session", "run"])
+        return x, np.array(ys), metadata
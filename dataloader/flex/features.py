@@ -0,0 +1,89 @@
+"""
+Batched trial covariances and tangent-space features
+
+======================
+Authors: Cuong Pham
+cuongquocpham151@gmail.com
+
+"""
+import numpy as np
+
+
+#=========================#
+def covariances(x, shrinkage=None, chunk_bytes:int = 2**22) -> np.ndarray:
+    """
+    Covariance matrix of every trial (and band) of <x> (trials, channels,
+    times[, bands]) -> (trials[, bands], channels, channels), as np.cov
+    (demeaned, /(times-1)), in batched matmul calls of ~<chunk_bytes>.
+    <shrinkage>: None, float a in [0, 1] ((1-a)C + a tr(C)/n I), or
+    "oas" (Oracle Approximating Shrinkage, a per matrix as sklearn's oas).
+    """
+    x = np.asarray(x)
+    if x.ndim == 4: # bands next to trials
+        x = x.transpose(0, 3, 1, 2)
+    n_chans, n_times = x.shape[-2:]
+    out = np.empty(x.shape[:-1] + (n_chans,), dtype=np.result_type(x.dtype, np.float32))
+    chunk = max(1, chunk_bytes // max(x[0].nbytes, 1)) if len(x) else 1
+    for i in range(0, len(x), chunk):
+        c = x[i:i+chunk]
+        c = c - c.mean(axis=-1, keepdims=True)
+        np.matmul(c, np.swapaxes(c, -1, -2), out=out[i:i+chunk])
+    out /= n_times - 1
+    if shrinkage is not None:
+        out = shrink(out, shrinkage, n_times)
+    return out
+
+
+#=========================#
+def shrink(covs, shrinkage, n_times:int = None) -> np.ndarray:
+    """ Shrink <covs> (..., n, n) in place towards tr(C)/n I, see covariances() """
+
+    n = covs.shape[-1]
+    mu = np.trace(covs, axis1=-2, axis2=-1) / n
+    if shrinkage == "oas":
+        emp = covs * ((n_times - 1) / n_times) # sklearn uses the biased estimate
+        alpha = np.mean(emp ** 2, axis=(-2, -1))
+        mu_emp = mu * ((n_times - 1) / n_times)
+        num = alpha + mu_emp ** 2
+        den = (n_times + 1) * (alpha - mu_emp ** 2 / n)
+        a = np.where(den == 0, 1.0, np.minimum(num / np.where(den == 0, 1, den), 1.0))
+    else:
+        a = np.full(mu.shape, float(shrinkage))
+    covs *= (1 - a)[..., None, None]
+    diag = np.einsum("...ii->...i", covs) # writable view of the diagonals
+    diag += (a * mu)[..., None]
+    return covs
+
+
+#=========================#
+def _eig_apply(covs, func) -> np.ndarray:
+    """ func applied to the eigenvalues of symmetric <covs> (..., n, n), batched """
+
+    w, v = np.linalg.eigh(covs)
+    return (v * func(w)[..., None, :]) @ np.swapaxes(v, -1, -2)
+
+
+def mean_logeuclid(covs) -> np.ndarray:
+    """ log-Euclidean mean of <covs> (trials, ..., n, n) over trials """
+    return _eig_apply(_eig_apply(covs, np.log).mean(axis=0), np.exp)
+
+
+def tangent_space(covs, reference=None) -> np.ndarray:
+    """
+    Tangent vectors of <covs> (trials[, bands], n, n) at <reference>
+    ([bands,] n, n), upper triangle with off-diagonal terms * sqrt(2)
+    -> (trials[, bands], n(n+1)/2). Use the reference of the training
+    trials only (default: log-Euclidean mean of <covs>).
+    Usage:
+        ref = mean_logeuclid(covs[train])
+        z_train, z_test = tangent_space(covs[train], ref), tangent_space(covs[test], ref)
+    """
+    if reference is None:
+        reference = mean_logeuclid(covs)
+    isqrt = _eig_apply(reference, lambda w: 1 / np.sqrt(w))
+    logs = _eig_apply(isqrt @ covs @ isqrt, np.log)
+
+    n = covs.shape[-1]
+    rows, cols = np.triu_indices(n)
+    weights = np.where(rows == cols, 1.0, np.sqrt(2))
+    return logs[..., rows, cols] * weights
@@ -0,0 +1,167 @@
+"""
+Native filter bank for Formulate
+
+======================
+Authors: Cuong Pham
+cuongquocpham151@gmail.com
+
+"""
+import numpy as np
+import mne
+from scipy.signal import sosfiltfilt
+from moabb.paradigms import MotorImagery
+from moabb.datasets.preprocessing import NamedFunctionTransformer
+
+
+#=========================#
+_IIR = {} # {(fs, band, order): iir_params}
+
+def get_iir(fs:float, band:list, order:int = 4) -> dict:
+    """
+    Return iir_params (sos, padlen) of the butterworth bandpass used by
+    MNE raw.filter(method="iir"), designed once per (fs, band, order).
+    """
+    key = (float(fs), tuple(band), order)
+    if key not in _IIR:
+        _IIR[key] = mne.filter.create_filter(
+            None, fs, l_freq=band[0], h_freq=band[1], method="iir",
+            iir_params=dict(order=order, ftype="butter", output="sos"),
+            verbose=False)
+    return _IIR[key]
+
+
+#=========================#
+FLOAT32_RTOL = 1e-3 # max |float32 - float64| / max |float64| of a filtered band
+_PRECISE = {} # {(fs, band, order, dtype, rtol, seconds): bool}
+
+def _filtfilt(x, iir:dict, dtype):
+    """ sosfiltfilt of <x> along the last axis with coefficients in <dtype> """
+    padlen = min(iir["padlen"], x.shape[-1] - 1)
+    return sosfiltfilt(iir["sos"].astype(dtype), x, axis=-1, padtype="odd", padlen=padlen)
+
+
+def precision_error(data, fs:float, bands:list, order:int = 4, dtype = "float32"):
+    """
+    Per band, max |filtered in <dtype> - filtered in float64| / max |filtered
+    in float64| of <data> (channels, times) -> (bands,)
+    """
+    out = []
+    for band in bands:
+        iir = get_iir(fs, band, order)
+        ref = _filtfilt(np.asarray(data, dtype=np.float64), iir, np.float64)
+        low = _filtfilt(np.asarray(data, dtype=dtype), iir, dtype)
+        out.append(np.abs(low - ref).max() / max(np.abs(ref).max(), np.finfo(float).tiny))
+    return np.array(out)
+
+
+def is_precise(fs:float, band:list, order:int = 4, dtype = "float32",
+               rtol:float = FLOAT32_RTOL, seconds:float = 60) -> bool:
+    """
+    Whether <band> filtered in <dtype> stays within <rtol> of float64, checked
+    once per (fs, band, order) on drifting noise of <seconds> (rounded up to
+    a power of 2, with a 2x margin), as the error grows with the length of
+    the recording.
+    Low bands at high fs fail first: their poles sit too close to 1.
+    """
+    dtype = np.dtype(dtype)
+    seconds = 2 ** int(np.ceil(np.log2(max(seconds, 64))))
+    key = (float(fs), tuple(band), order, dtype.str, rtol, seconds)
+    if key not in _PRECISE:
+        rng = np.random.default_rng(0)
+        n = int(seconds * fs)
+        probe = np.cumsum(rng.standard_normal(n)) * 0.1 + rng.standard_normal(n)
+        _PRECISE[key] = bool(precision_error(probe[None], fs, [band], order, dtype)[0] <= rtol/2)
+    return _PRECISE[key]
+
+
+#=========================#
+def filter_bank(data, fs:float, bands:list, order:int = 4, dtype = None,
+                rtol:float = FLOAT32_RTOL):
+    """
+    Zero-phase filter continuous <data> (channels, times) with every band
+    -> (bands, channels, times). Each band is one sosfiltfilt call over all
+    channels, with the same odd-reflection padding as MNE.
+    With a lower precision <dtype> (float32) the output is stored in
+    <dtype>, and bands that fail is_precise(<rtol>) are computed in float64.
+    """
+    dtype = data.dtype if dtype is None else np.dtype(dtype)
+    x = np.asarray(data, dtype=dtype)
+    out = np.empty((len(bands),) + x.shape, dtype=dtype)
+    for i, band in enumerate(bands):
+        iir = get_iir(fs, band, order)
+        precise = dtype == np.float64 or \
+            is_precise(fs, band, order, dtype, rtol, x.shape[-1] / fs)
+        out[i] = _filtfilt(x, iir, dtype if precise else np.float64)
+    return out
+
+
+#=========================#
+class FilterBankMI(MotorImagery):
+    """
+    Drop-in for moabb FilterBankMotorImagery, x is (trials, channels, times, bands).
+    MOABB loads the dataset, filters all its channels and epochs once per
+    band. Here the dataset is loaded once, only <channels> go through
+    filter_bank() (bands become extra channels "C3#0", "C3#1", ...) and
+    the result is epoched once.
+
+    Usage:
+        paradigm = FilterBankMI(filters=[[8,13],[13,30]], events=["left_hand", "right_hand"],
+                                n_classes=2, tmin=0, tmax=2, channels=("C3", "Cz", "C4"),
+                                resample=128)
+        x, y, metadata = paradigm.get_data(dataset=dataset, subjects=[1])
+    """
+    def __init__(self, filters, dtype=None, **kwargs):
+        super().__init__(fmin=filters[0][0], fmax=filters[0][1], **kwargs)
+        self.bands = [list(band) for band in filters]
+        self.dtype = dtype
+
+    def _band_channels(self):
+        if self.channels is None:
+            return None
+        return [f"{ch}#{i}" for ch in self.channels for i in range(len(self.bands))]
+
+    def _filter_raw(self, raw):
+        """raw -> RawArray of filtered (channel, band) pairs + stim channels"""
+
+        picks = list(self.channels) if self.channels is not None else \
+            [raw.ch_names[i] for i in mne.pick_types(raw.info, eeg=True)]
+        stims = [raw.ch_names[i] for i in mne.pick_types(raw.info, eeg=False, stim=True)]
+        sfreq = raw.info["sfreq"]
+
+        x = filter_bank(raw.get_data(picks=picks), sfreq, self.bands, dtype=self.dtype)
+        n_bands, n_chans, n_times = x.shape
+        data = np.empty((n_chans*n_bands + len(stims), n_times))
+        data[:n_chans*n_bands] = x.transpose(1, 0, 2).reshape(-1, n_times)
+        if stims:
+            data[n_chans*n_bands:] = raw.get_data(picks=stims)
+
+        ch_names = [f"{ch}#{i}" for ch in picks for i in range(n_bands)] + stims
+        ch_types = ["eeg"] * (n_chans*n_bands) + ["stim"] * len(stims)
+        info = mne.create_info(ch_names=ch_names, ch_types=ch_types, sfreq=sfreq)
+        out = mne.io.RawArray(data, info, first_samp=raw.first_samp, verbose=False)
+        out.set_meas_date(raw.info["meas_date"])
+        out.set_annotations(raw.annotations)
+        return out
+
+    def _get_raw_pipelines(self):
+        return [NamedFunctionTransformer(func=self._filter_raw,
+                    display_name=f"Native Filter Bank ({len(self.bands)} bands)")]
+
+    # private moabb BaseProcessing._get_epochs_pipeline (epochs of the
+    # band channels), checked with moabb 1.7, see README
+    def _get_epochs_pipeline(self, return_epochs, return_raws, dataset):
+        channels, self.channels = self.channels, self._band_channels()
+        try:
+            return super()._get_epochs_pipeline(return_epochs, return_raws, dataset)
+        finally:
+            self.channels = channels
+
+    def get_data(self, dataset, subjects=None, return_epochs=False, **kwargs):
+        if return_epochs or kwargs.get("return_raws"):
+            raise ValueError("FilterBankMI only returns arrays")
+        x, y, metadata = super().get_data(dataset, subjects, **kwargs)
+        n_trials, _, n_times = x.shape
+        x = x.reshape(n_trials, -1, len(self.bands), n_times).transpose(0, 1, 3, 2)
+        if self.dtype is not None:
+            x = x.astype(self.dtype)
+        return x, y, metadata
@@ -7,11 +7,21 @@ cuongquocpham151@gmail.com
 
 """
 import os
+import re
+import logging
 import numpy as np
 import pandas as pd
 import mne
+from joblib import Parallel, delayed
 from moabb.datasets.base import BaseDataset
 from config import *
+from instrument import instrumented
+from tree_index import update_index
+
+INDEX_FILE = ".flex2023_index.json" # manifest of dir_raw_data, see get_index()
+
+log = logging.getLogger(__name__)
+
 
 ################################
 class Flex2023_moabb(BaseDataset):
@@ -21,6 +31,9 @@ class Flex2023_moabb(BaseDataset):
         protocol (str): Protocol name. Defaults to "8c".
         session (str): session name. Defaults to "ss1".
         run (str): run name. Defaults to "run1".
+        n_jobs (int): number of processes decoding/filtering runs. Defaults to 1.
+        preallocate (bool): decode and filter all runs in place in one
+            (33, N_total) buffer instead of concatenating copies. Defaults to False.
     
     """
     def __init__(
@@ -28,7 +41,9 @@ class Flex2023_moabb(BaseDataset):
         dir_raw_data:str = "",
         protocol:str= "8c", 
         session:str= "ss1", 
-        run:str= "run1"
+        run:str= "run1",
+        n_jobs:int= 1,
+        preallocate:bool= False,
     ):
 
         if "4c" in protocol:
@@ -49,17 +64,40 @@ class Flex2023_moabb(BaseDataset):
         self.protocol = protocol
         self.session = session
         self.run = run
-
-        print(self.dir_raw_data)
-
-    def _flow(self, raw0, stim):
-        """Single flow of raw processing"""
-
-        ## get eeg (32,N)
-        data = raw0.get_data(picks=EEG_CH_NAMES)
-
-        # stack eeg (32,N) with stim (1,N) => (32, N)
-        data = np.vstack([data, stim.reshape(1,-1)])
+        self.n_jobs = n_jobs
+        self.preallocate = preallocate
+        self._index = {}
+
+        log.debug(self.dir_raw_data)
+
+    def get_index(self, refresh:bool = False) -> dict:
+        """
+        Return manifest of dir_raw_data, stored in dir_raw_data/INDEX_FILE
+            {
+                "tree": scan_tree(dir_raw_data),
+                "subjects": {"12": [../F12_8c_ss1_run1.edf, ...]},
+            }
+        Later instances only re-list folders whose mtime changed.
+        """
+        if self._index and not refresh:
+            return self._index
+
+        def build(tree):
+            subjects = {}
+            for folder, entry in sorted(tree.items()):
+                for file in sorted(entry["files"]):
+                    m = re.search(r"F(\d+)_", file)
+                    if m and file.endswith(".edf") and (".md" not in file):
+                        subjects.setdefault(str(int(m.group(1))), []) \
+                            .append(os.path.join(folder, file))
+            return dict(subjects=subjects)
+
+        self._index = update_index(
+            self.dir_raw_data, os.path.join(self.dir_raw_data, INDEX_FILE), build)
+        return self._index
+
+    def _make_raw(self, data):
+        """RawArray on <data> (33,N) = eeg (32,N) + stim (1,N), no copy"""
 
         ch_types = ["eeg"]*32 + ["stim"]
         ch_names = EEG_CH_NAMES + ["Stim"]
@@ -71,20 +109,78 @@ class Flex2023_moabb(BaseDataset):
                               verbose=False)
         montage = mne.channels.make_standard_montage("standard_1020")
         raw.set_montage(montage)
-        # print(raw0.info)
-        # print(raw.info)
+        return raw
+
+
+    @instrumented("flex2023._flow", lambda self, data: dict(n_times=data.shape[1]))
+    def _flow(self, data):
+        """Single flow of raw processing, <data> (33,N) is filtered in place"""
 
+        raw = self._make_raw(data)
         raw.filter(l_freq=1.0, h_freq=None, method='iir') \
             .notch_filter(freqs=[50])
         #     .set_eeg_reference(ref_channels='average')
         return raw
 
 
-    def _get_stim_data(self, edf_raw, subject):
+    def _open_edf(self, edf, subject):
+        """Open one edf (header only) with EEG_CH_NAMES + marker channels"""
+
         assert int(subject) >= 12
-        return edf_raw.get_data(picks=["MarkerValueInt"], units='uV')[0]
+        return mne.io.read_raw_edf(edf, include=EEG_CH_NAMES + ["MarkerValueInt"],
+                                   preload=False)
+
+
+    def _read_edf(self, raw0, out=None):
+        """
+        Decode eeg (32,N) + stim (1,N) of one opened edf in a single pass.
+        Only EEG_CH_NAMES and the marker are read (EMOTIV files also carry
+        motion/quality channels), straight into one (33,N) array <out>.
+        """
+        picks = EEG_CH_NAMES + ["MarkerValueInt"]
+        sel = [raw0.ch_names.index(ch) for ch in picks]
+        # private mne BaseRaw._read_segment (decodes into <out>, no copy),
+        # as get_data(picks); checked with mne 1.13, see README
+        data = raw0._read_segment(sel=sel, data_buffer=out)
+        data[-1] *= 1e6 # marker value, same as get_data(units='uV')
+        return data
+
+
+    def _load_run(self, edf, subject):
+        """Decode and process one run (edf file)"""
+
+        return self._flow(self._read_edf(self._open_edf(edf, subject)))
+
+
+    def _load_runs_preallocated(self, list_edf, subject):
+        """
+        Decode and filter runs in place, each in its slice of one
+        (33, N_total) buffer. Run boundaries are annotated as done by
+        mne.concatenate_raws.
+        """
+        list_raw0 = [self._open_edf(_edf, subject) for _edf in list_edf]
+        bounds = np.cumsum([0] + [raw0.n_times for raw0 in list_raw0])
+        data = np.empty((len(EEG_CH_NAMES)+1, bounds[-1]))
+
+        def load(raw0, out):
+            self._flow(self._read_edf(raw0, out))
+
+        # threads, as runs are written into the shared buffer
+        Parallel(n_jobs=self.n_jobs, require="sharedmem")(
+            delayed(load)(raw0, data[:, bounds[i]:bounds[i+1]]) \
+                for i, raw0 in enumerate(list_raw0))
+
+        raw = self._make_raw(data)
+        onsets = np.repeat(bounds[1:-1] / FS, 2)
+        raw.set_annotations(mne.Annotations(
+            onset=onsets,
+            duration=np.zeros(len(onsets)),
+            description=["BAD boundary", "EDGE boundary"] * (len(bounds)-2)))
+        return raw
 
 
+    @instrumented("flex2023._get_single_subject_data",
+                  lambda self, subject: dict(subject=subject))
     def _get_single_subject_data(self, subject):
         """Return data for a single subject."""
 
@@ -96,28 +192,24 @@ class Flex2023_moabb(BaseDataset):
         else:
             list_edf_select = [p for p in list_edf if self.run in p]
 
-        # concat runs 
-        list_raw = []
-        for _edf in list_edf_select:
-            raw0 = mne.io.read_raw_edf(_edf, preload=False)
-            stim = self._get_stim_data(raw0, subject)
-            raw_run = self._flow(raw0, stim)
-            list_raw.append(raw_run)
-        raw = mne.concatenate_raws(list_raw)
+        # concat runs (in order of list_edf_select)
+        if self.preallocate:
+            raw = self._load_runs_preallocated(list_edf_select, subject)
+        else:
+            list_raw = Parallel(n_jobs=self.n_jobs)(
+                delayed(self._load_run)(_edf, subject) for _edf in list_edf_select)
+            raw = mne.concatenate_raws(list_raw)
 
         return {"0": {"0": raw}}
 
 
+    @instrumented("flex2023.data_path", lambda self, subject, **kwargs: dict(subject=subject))
     def data_path(self, subject, **kwargs) -> None:
         """Return list of path of edf files for predefined protocols"""
 
-        list_edf = []
         subkey = f"F{subject}_{self.protocol}_{self.session}"
-        for root, dirs, files in os.walk(self.dir_raw_data):
-            for file in files:
-                if file.endswith(".edf") and \
-                    (subkey in file) and (".md" not in file):
-                        list_edf.append(os.path.join(root, file))
+        list_edf = [p for p in self.get_index()["subjects"].get(str(subject), []) \
+            if subkey in os.path.basename(p)]
         if list_edf:
             return list_edf
         else:
@@ -7,12 +7,26 @@ Authors: Cuong Pham
 cuongquocpham151@gmail.com
 
 """
+import copy
+import logging
 import numpy as np
+from joblib import Parallel, delayed
 from moabb.paradigms import MotorImagery, FilterBankMotorImagery
 from sklearn.preprocessing import LabelEncoder
 from config import *
+from filterbank import FilterBankMI
+from epoching import NativeMI, resample_epochs, run_events, kept_events
+from instrument import instrumented
+from quality import screen
+from features import covariances
 
 
+# 8c protocol: "<task>_r" are the trials followed by a rest period
+LABEL_8C_MI = {k: k[:-2] if "_r" in k else k for k in EVENT_IDX_8CLASS}
+LABEL_8C_REST = {k: "rest" if "_r" in k else "no_rest" for k in EVENT_IDX_8CLASS}
+
+log = logging.getLogger(__name__)
+
 
 ################################
 class Formulate():
@@ -25,6 +39,11 @@ class Formulate():
         t_rest = (-4,-2),
         t_mi = (0,2),
         run_to_split = None,
+        cache = None,
+        native_fb = False,
+        native_epochs = False,
+        dtype = None,
+        quality = None,
         ):
         """
         Usage:
@@ -36,8 +55,26 @@ class Formulate():
                         t_rest = (-4,-2),
                         t_mi = (0,2),
                         run_to_split=None,
+                        cache=EpochCache("/home/pham/bci/CACHE"),
+                        native_fb=False,
+                        native_epochs=False,
+                        dtype=None,
+                        quality=None,
                         )
             x, y = f.form(model_name="MI_2class_hand")
+
+        dtype="float32" returns (and caches) float32 x. With native_fb or
+        native_epochs, filtering and epoching also run in float32 (bands
+        that would lose precision are filtered in float64, see
+        filterbank.is_precise). Default keeps the float64 of MNE/MOABB.
+
+        quality: screen() thresholds, e.g. dict(ptp=150, flat=0.5, var_z=5)
+        (uV). form() then drops the rejected trials, its masks and report
+        are kept in self.quality_masks / self.quality_report.
+
+        Epochs are extracted once per superset of events (4c/8c) and
+        kept on the instance, so build a new Formulate after changing
+        the dataset (e.g. dataset.run).
         """
         self.dataset = dataset
         self.subject = subject
@@ -46,6 +83,24 @@ class Formulate():
         self.t_rest = t_rest
         self.t_mi = t_mi
         self.run_to_split = run_to_split
+        self.cache = cache # EpochCache or None
+        self.native_fb = native_fb # multi-band with FilterBankMI
+        self.native_epochs = native_epochs # NumPy epoching (NativeMI) instead of mne.Epochs
+        self.dtype = dtype # x dtype, None: float64
+        self.quality = quality # screen() thresholds or None
+        self.quality_masks, self.quality_report = None, None # of the last form()
+
+        # extracted epochs at the dataset rate, reused across form() calls
+        # {((events, bandpass, channels), interval): (x, y, sfreq)}
+        self._epochs = {}
+        # events per run of the subject, to reuse a wider epoch only when
+        # it keeps the same trials, {events: [(samples, n_times, sfreq, bads)]}
+        self._events = {}
+
+        # covariance mode of form_cov(), {"shrinkage": ...} or None
+        # {(events, bandpass, channels, interval, shrinkage): (covs, y)}
+        self._cov = None
+        self._covs = {}
 
     #-----------------------------------#
     def _extract_split_run(self, event_ids, interval):
@@ -80,11 +135,29 @@ class Formulate():
 
 
     #-----------------------------------#
-    def _extract(self, returns:str, event_ids:dict, interval:tuple):
+    @instrumented("formulate._extract",
+                  lambda self, returns, event_ids, interval, resample=FS: dict(
+                      subject=self.subject, events=len(event_ids), interval=list(interval)))
+    def _extract(self, returns:str, event_ids:dict, interval:tuple, resample=FS):
         """
-        Get data/epochs
+        Get data/epochs, resampled to <resample> (None: dataset rate)
         """
-        if self.bandpass is None:
+        if self.native_epochs and returns == "xy":
+            bands = self.bandpass or [[0, FS/2-0.001]]
+            paradigm = NativeMI(
+                    filters = bands if len(bands) > 1 else None,
+                    fmin = bands[0][0],
+                    fmax = bands[0][1],
+                    events = list(event_ids.keys()),
+                    n_classes = len(event_ids.keys()),
+                    tmin = interval[0],
+                    tmax = interval[1],
+                    channels=self.channels,
+                    resample=resample,
+                    dtype=self.dtype,
+                    )
+
+        elif self.bandpass is None:
             paradigm = MotorImagery(
                     events = list(event_ids.keys()),
                     n_classes = len(event_ids.keys()),
@@ -93,7 +166,7 @@ class Formulate():
                     tmin = interval[0], 
                     tmax = interval[1], 
                     channels=self.channels,
-                    resample=FS,
+                    resample=resample,
                     )
 
         elif len(self.bandpass) == 1:
@@ -105,9 +178,21 @@ class Formulate():
                     tmin = interval[0], 
                     tmax = interval[1], 
                     channels=self.channels,
-                    resample=FS,
+                    resample=resample,
                     )
         
+        elif len(self.bandpass) > 1 and self.native_fb:
+            paradigm = FilterBankMI(
+                    filters=self.bandpass,
+                    events = list(event_ids.keys()),
+                    n_classes = len(event_ids.keys()),
+                    tmin = interval[0],
+                    tmax = interval[1],
+                    channels=self.channels,
+                    resample=resample,
+                    dtype=self.dtype,
+                    )
+
         elif len(self.bandpass) > 1:
             paradigm = FilterBankMotorImagery(
                     filters=self.bandpass,
@@ -116,7 +201,7 @@ class Formulate():
                     tmin = interval[0],
                     tmax = interval[1],
                     channels=self.channels,
-                    resample=FS,
+                    resample=resample,
                     )
 
         if returns == "epochs":
@@ -126,17 +211,219 @@ class Formulate():
             return epochs
 
         elif returns == "xy":
-            x,y,_ = paradigm.get_data(dataset=self.dataset,
-                        subjects=[self.subject])
+            def get_data():
+                x,y,metadata = paradigm.get_data(dataset=self.dataset,
+                            subjects=[self.subject])
+                if self.dtype is not None:
+                    x = x.astype(self.dtype, copy=False)
+                return x, y, metadata
+
+            if self.cache is None:
+                x,y,_ = get_data()
+                return x, y
+
+            params = dict(native_fb=self.native_fb)
+            if self.dtype is not None:
+                params["dtype"] = np.dtype(self.dtype).name
+            key = self.cache.key(self.dataset, self.subject,
+                        events=list(event_ids.keys()),
+                        bandpass=self.bandpass,
+                        channels=self.channels,
+                        interval=interval,
+                        resample=resample,
+                        **params)
+            x,y,_ = self.cache.get_or_extract(key, get_data)
             return x, y
 
 
+    #-----------------------------------#
+    def _available(self, event_ids:dict) -> dict:
+        """
+        <event_ids> restricted to the events of the dataset, so a superset
+        (4c/8c) is extracted with the classes this dataset has (e.g. only
+        left/right hand for Cho2017), MOABB rejects missing events.
+        """
+        events = getattr(self.dataset, "event_id", None)
+        if not events:
+            return event_ids
+        return {k: v for k, v in event_ids.items() if k in events} or event_ids
+
+
+    #-----------------------------------#
+    def _get(self, event_ids:dict, interval:tuple):
+        """ x/y of <event_ids> at <interval>, covariances in form_cov() """
+
+        if self._cov is not None:
+            return self._get_cov(event_ids, interval)
+        return self._get_epochs(event_ids, interval)
+
+
+    #-----------------------------------#
+    def _native(self, event_ids:dict, interval:tuple):
+        """
+        x (dataset rate), y, sfreq and span of an extracted epoch of
+        <event_ids> covering <interval> with its trials, extracted over
+        <interval> if none.
+        """
+        event_ids = self._available(event_ids)
+        key = (tuple(event_ids), str(self.bandpass), tuple(self.channels))
+        for (k, span), (x, y, sfreq) in self._epochs.items():
+            if k == key and span[0] <= interval[0] and interval[1] <= span[1] \
+                    and self._same_trials(event_ids, span, interval):
+                return x, y, sfreq, span
+
+        span = tuple(interval)
+        x, y = self._extract("xy", event_ids, span, resample=None)
+        sfreq = round((x.shape[2] - 1) / (span[1] - span[0]), 6)
+        self._epochs[(key, span)] = (x, y, sfreq)
+        return x, y, sfreq, span
+
+
+    #-----------------------------------#
+    def _same_trials(self, event_ids:dict, span:tuple, interval:tuple) -> bool:
+        """
+        An epoch over <span> has the trials an extraction of <interval>
+        would have: no event is dropped (recording edges, bad annotations)
+        at <span> that <interval> keeps.
+        """
+        if tuple(span) == tuple(interval):
+            return True
+        key = tuple(event_ids)
+        if key not in self._events:
+            codes = getattr(self.dataset, "event_id", None) or event_ids
+            self._events[key] = run_events(self.dataset, self.subject,
+                                           {k: codes[k] for k in event_ids})
+        offset = self.dataset.interval[0]
+        for samples, n_times, sfreq, bads in self._events[key]:
+            _, wide = kept_events(samples, n_times, sfreq, bads,
+                                  span[0] + offset, span[1] + offset)
+            _, narrow = kept_events(samples, n_times, sfreq, bads,
+                                    interval[0] + offset, interval[1] + offset)
+            if not np.array_equal(wide, narrow):
+                return False
+        return True
+
+
+    #-----------------------------------#
+    def _get_epochs(self, event_ids:dict, interval:tuple):
+        """
+        Get x/y of <event_ids> at <interval>, sliced from an already
+        extracted (wider) epoch of the same events and trials when there
+        is one.
+        Epochs are kept at the dataset rate and each window is resampled
+        to FS after slicing, as a direct extraction of it would be.
+        """
+        x, y, sfreq, span = self._native(event_ids, interval)
+        return resample_epochs(self._crop(x, span, interval, sfreq), sfreq, FS), y
+
+
+    #-----------------------------------#
+    def epochs(self, event_ids:dict, interval:tuple):
+        """
+        x, y (event names, not encoded) of <event_ids> at <interval> (s),
+        e.g. to store the epochs and slice model windows from them later
+        """
+        return self._get_epochs(event_ids, interval)
+
+
+    #-----------------------------------#
+    def _get_cov(self, event_ids:dict, interval:tuple, span:tuple = None):
+        """
+        Covariances (trials[, bands], channels, channels) and y of
+        <event_ids> at <interval>, over the samples form() keeps. Computed
+        once per window for every sub-task mask of the same events, kept on
+        the instance and in the cache. On a miss the epochs are extracted
+        over <span> (default: <interval>) and cropped.
+        """
+        event_ids = self._available(event_ids)
+        shrinkage = self._cov["shrinkage"]
+        key = (tuple(event_ids), str(self.bandpass), tuple(self.channels),
+               tuple(interval), str(shrinkage))
+        if key in self._covs:
+            return self._covs[key]
+
+        def get_data():
+            if span is not None:
+                self._native(event_ids, span)
+            x, y = self._get_epochs(event_ids, interval)
+            x = x[:,:,:-1]
+            if self.quality is not None:
+                masks, report = screen(x, channels=self.channels, **self.quality)
+                log.info(f"(cov {interval}) | quality: {report}")
+                keep = np.flatnonzero(~masks["reject"])
+                x, y = x[keep], y[keep]
+            return covariances(x, shrinkage=shrinkage), y, None
+
+        if self.cache is None:
+            covs, y, _ = get_data()
+        else:
+            params = dict(native_fb=self.native_fb, feature="cov", shrinkage=shrinkage)
+            if self.dtype is not None:
+                params["dtype"] = np.dtype(self.dtype).name
+            if self.quality is not None:
+                params["quality"] = self.quality
+            cache_key = self.cache.key(self.dataset, self.subject,
+                        events=list(event_ids.keys()),
+                        bandpass=self.bandpass,
+                        channels=self.channels,
+                        interval=interval,
+                        resample=FS,
+                        **params)
+            covs, y, _ = self.cache.get_or_extract(cache_key, get_data)
+
+        self._covs[key] = (covs, y)
+        return covs, y
+
+
+    #-----------------------------------#
+    def _extract_windows(self, event_ids:dict, intervals:list):
+        """
+        Get x/y for several time windows from a single wide epoch.
+        The raw data is loaded/filtered once over the span covering all
+        intervals, then each interval is sliced in numpy.
+        Usage:
+            (x_rest, y), (x_mi, _) = self._extract_windows(
+                EVENT_IDX_4CLASS, [self.t_rest, self.t_mi])
+        """
+        span = (min(i[0] for i in intervals), max(i[1] for i in intervals))
+        if self._cov is not None:
+            return [self._get_cov(event_ids, i, span) for i in intervals]
+        self._native(event_ids, span)
+        return [self._get(event_ids, i) for i in intervals]
+
+
+    #-----------------------------------#
+    @staticmethod
+    def _crop(x, span:tuple, interval:tuple, sfreq:float = FS):
+        """
+        slice <interval> (s) from epochs <x> extracted over <span> (s) at
+        <sfreq>, the samples mne.Epochs takes for <interval>
+        """
+        start = int(round(interval[0] * sfreq)) - int(round(span[0] * sfreq))
+        n_times = int(round(interval[1] * sfreq)) - int(round(interval[0] * sfreq)) + 1
+        return x[:, :, start:start+n_times]
+
+
+    #-----------------------------------#
+    @staticmethod
+    def _select(x, y, keep:list=None, mapping:dict=None):
+        """ keep trials with label in <keep>, then rename labels by <mapping> """
+
+        if keep is not None:
+            mask = np.isin(y, keep)
+            x, y = x[mask], y[mask]
+        if mapping is not None:
+            names, inv = np.unique(y, return_inverse=True)
+            y = np.array([mapping.get(i, i) for i in names])[inv]
+        return x, y
+
+
     #-----------------------------------#
     def _4c_rest(self)->None:
         """ binary classifier: Rest/MI """
 
-        x_rest,_ = self._extract("xy", EVENT_IDX_4CLASS, self.t_rest)
-        x_mi,_ = self._extract("xy", EVENT_IDX_4CLASS, self.t_mi)
+        (x_rest,_), (x_mi,_) = self._extract_windows(
+            EVENT_IDX_4CLASS, [self.t_rest, self.t_mi])
 
         y_rest = np.array(['rest'] * x_rest.shape[0])
         y_mi = np.array(['mi'] * x_mi.shape[0])
@@ -148,31 +435,30 @@ class Formulate():
     def _4c_all(self)->None:
         """ classifier: LH/RH/LF/RF (4class) """
 
-        x, y = self._extract("xy", EVENT_IDX_4CLASS, self.t_mi)
+        x, y = self._get(EVENT_IDX_4CLASS, self.t_mi)
         return x, y
 
     #-----------------------------------#
     def _4c_2class_hand(self)->None:
         """ binary classifier (LH/RH) """
 
-        event_ids = dict(right_hand=1, left_hand=2)
-        x, y = self._extract("xy", event_ids, self.t_mi)
-        return x, y
+        x, y = self._get(EVENT_IDX_4CLASS, self.t_mi)
+        return self._select(x, y, keep=["right_hand", "left_hand"])
 
     #-----------------------------------#
     def _4c_2class_foot(self)->None:
         """ binary classifier (LF/RF) """
 
-        event_ids = dict(right_foot=3, left_foot=4)
-        x, y = self._extract("xy", event_ids, self.t_mi)
-        return x, y
+        x, y = self._get(EVENT_IDX_4CLASS, self.t_mi)
+        return self._select(x, y, keep=["right_foot", "left_foot"])
 
     #-----------------------------------#
     def _4c_2class_hand_foot(self)->None:
         """ binary classifier (LH+RH) & (LF+RF) """
         
-        x1,_ = self._extract("xy", dict(right_hand=1, left_hand=2), self.t_mi)
-        x2,_ = self._extract("xy", dict(right_foot=3, left_foot=4), self.t_mi)
+        x, y = self._get(EVENT_IDX_4CLASS, self.t_mi)
+        x1,_ = self._select(x, y, keep=["right_hand", "left_hand"])
+        x2,_ = self._select(x, y, keep=["right_foot", "left_foot"])
 
         y1 = np.array(['hand'] * x1.shape[0])
         y2 = np.array(['foot'] * x2.shape[0])
@@ -184,34 +470,30 @@ class Formulate():
     def _4c_3class_rf(self)->None:
         """ classifier (LH/RH/RF) """
 
-        event_ids = dict(right_hand=1, left_hand=2, right_foot=3)
-        x, y = self._extract("xy", event_ids, self.t_mi)
-        return x, y
+        x, y = self._get(EVENT_IDX_4CLASS, self.t_mi)
+        return self._select(x, y, keep=["right_hand", "left_hand", "right_foot"])
 
     #-----------------------------------#
     def _4c_3class_lf(self)->None:
         """ classifier (LH/RH/LF) """
 
-        event_ids = dict(right_hand=1, left_hand=2, left_foot=4)
-        x, y = self._extract("xy", event_ids, self.t_mi)
-        return x, y
+        x, y = self._get(EVENT_IDX_4CLASS, self.t_mi)
+        return self._select(x, y, keep=["right_hand", "left_hand", "left_foot"])
 
     #-----------------------------------#
     def _8c_rest(self, t_rest=(2.5, 4.5))->None:
         """ get data REST (using t_rest in the final 3s of trial.)"""
 
-        x,_ = self._extract("xy", EVENT_IDX_8CLASS, t_rest)
-        y = ["rest" if "_r" in i else "no_rest" for i in _]
-        y = np.array(y)
-        return x, y
+        x, y = self._get(EVENT_IDX_8CLASS, t_rest)
+        return self._select(x, y, mapping=LABEL_8C_REST)
 
     #-----------------------------------#
     def _8c_rest_base(self)->None:
         """ get data REST BASE (using default t_rest before cue)"""
 
         # REST BASE (using t_rest before cue)
-        x_mi,_ = self._extract("xy", EVENT_IDX_8CLASS, (0,2))
-        x_rest,_ = self._extract("xy", EVENT_IDX_8CLASS, (-4,-2))
+        (x_mi,_), (x_rest,_) = self._extract_windows(
+            EVENT_IDX_8CLASS, [(0,2), (-4,-2)])
 
         y_rest = np.array(['rest'] * x_rest.shape[0])
         y_mi = np.array(['mi'] * x_mi.shape[0])
@@ -223,36 +505,32 @@ class Formulate():
     def _8c_mi(self)->None:
         """ get data for MI-4class model in 8c protocol """
 
-        x, y_global  = self._extract("xy", EVENT_IDX_8CLASS, (0, 2))
-        y = [i[:-2] if "_r" in i else i for i in y_global]
-        y = np.array(y)
-        return x, y
+        x, y = self._get(EVENT_IDX_8CLASS, (0, 2))
+        return self._select(x, y, mapping=LABEL_8C_MI)
 
 
     #-----------------------------------#
     def _8c_hand(self)->None:
         """ get data for LH-RH model in 8c protocol """
 
-        event_ids = dict(
-            right_hand=1, left_hand=2,
-            right_hand_r=5, left_hand_r=6,
-        )
-        x, y_global  = self._extract("xy", event_ids, (0, 2))
-        y = [i[:-2] if "_r" in i else i for i in y_global]
-        y = np.array(y)
-        return x, y
+        x, y = self._get(EVENT_IDX_8CLASS, (0, 2))
+        return self._select(x, y, 
+            keep=["right_hand", "left_hand", "right_hand_r", "left_hand_r"],
+            mapping=LABEL_8C_MI)
     
     #-----------------------------------#
     def form_8c(self, t_rest=(2.5, 4.5))->None:
         """ get data for combined validation"""
+
+        (x1, y_global), (x2, _) = self._extract_windows(
+            EVENT_IDX_8CLASS, [(0, 2), t_rest])
+
         # MI
-        x1, y_global  = self._extract("xy", EVENT_IDX_8CLASS, (0, 2))
-        y1 = [i[:-2] if "_r" in i else i for i in y_global]
+        _, y1 = self._select(x1, y_global, mapping=LABEL_8C_MI)
         le1 = LabelEncoder(); y1 = le1.fit_transform(y1)
 
         ## REST
-        x2, _ = self._extract("xy", EVENT_IDX_8CLASS, t_rest)
-        y2 = ["rest" if "_r" in i else "no_rest" for i in y_global]
+        _, y2 = self._select(x2, y_global, mapping=LABEL_8C_REST)
         le2 = LabelEncoder(); y2 = le2.fit_transform(y2)
 
         # ## debug
@@ -267,8 +545,101 @@ class Formulate():
         return (x1,y1,x2,y2, y_global, le1, le2)
 
 
+    #-----------------------------------#
+    def _windows(self, model_name:str):
+        """ superset events and time windows needed by <model_name> """
+
+        if model_name == "4c_rest":
+            return EVENT_IDX_4CLASS, [self.t_rest, self.t_mi]
+        elif model_name.startswith("4c"):
+            return EVENT_IDX_4CLASS, [self.t_mi]
+        elif model_name == "8c_rest":
+            return EVENT_IDX_8CLASS, [(2.5, 4.5)]
+        elif model_name.startswith("8c"):
+            return EVENT_IDX_8CLASS, [(0, 2)]
+        else:
+            raise ValueError(f"model_name {model_name} is not supported")
+
+
+
+    #-----------------------------------#
+    def sweep(self, model_name:str, intervals:list = None, bandpasses:list = None):
+        """
+        Lazily form <model_name> for every (t_mi, bandpass) of the grid
+        <intervals> x <bandpasses> (defaults: self.t_mi, self.bandpass).
+        The subject is loaded once: every distinct band is filtered once
+        (NativeMI filter bank) and epoched over the widest window, each
+        grid point is then a slice/band selection of that array.
+        8c models use fixed windows, only <bandpasses> apply to them.
+        Yield ((t_mi, bandpass), (x, y, le)) as form() of an instance with
+        that t_mi/bandpass does, formed on a copy (self is not changed).
+        Usage:
+            grid = f.sweep("4c_2class_hand",
+                           intervals=[(0,2), (0.5,2.5), (1,3)],
+                           bandpasses=[[[8,13]], [[13,30]], [[8,13],[13,30]]])
+            for (t_mi, bandpass), (x, y, le) in grid:
+                ...
+        """
+        intervals = [tuple(i) for i in (intervals or [self.t_mi])]
+        bandpasses = bandpasses or [self.bandpass]
+        full = [0, FS/2-0.001] # bandpass None
+
+        # distinct bands, widest window
+        bands = []
+        for bandpass in bandpasses:
+            for band in (bandpass or [full]):
+                if list(band) not in bands:
+                    bands.append(list(band))
+        # grid points are formed on a copy, self is left as it is
+        f = copy.copy(self)
+        windows = []
+        for interval in intervals:
+            f.t_mi = interval
+            event_ids, w = f._windows(model_name)
+            windows += w
+        event_ids = self._available(event_ids)
+        span = (min(i[0] for i in windows), max(i[1] for i in windows))
+
+        paradigm = NativeMI(
+                filters = bands,
+                events = list(event_ids.keys()),
+                n_classes = len(event_ids.keys()),
+                tmin = span[0],
+                tmax = span[1],
+                channels=self.channels,
+                resample=None, # dataset rate, each window is resampled
+                dtype=self.dtype,
+                )
+        get_data = lambda: paradigm.get_data(dataset=self.dataset, subjects=[self.subject])
+        if self.cache is None:
+            x, y, _ = get_data()
+        else:
+            key = self.cache.key(self.dataset, self.subject,
+                        events=list(event_ids.keys()),
+                        bands=bands,
+                        channels=self.channels,
+                        interval=span,
+                        resample=None,
+                        dtype=np.dtype(self.dtype or np.float64).name,
+                        sweep=True)
+            x, y, _ = self.cache.get_or_extract(key, get_data)
+        sfreq = round((x.shape[2] - 1) / (span[1] - span[0]), 6)
+
+        # each bandpass is put in the extracted epochs, form() slices it
+        for bandpass in bandpasses:
+            idx = [bands.index(list(band)) for band in (bandpass or [full])]
+            f.bandpass = bandpass
+            key = (tuple(event_ids), str(bandpass), tuple(self.channels))
+            x_band = x[..., idx[0]] if len(idx) == 1 else x[..., idx]
+            f._epochs = {(key, span): (x_band, y, sfreq)}
+            for interval in intervals:
+                f.t_mi = interval
+                yield (interval, bandpass), f.form(model_name)
+
 
     #-----------------------------------#
+    @instrumented("formulate.form", lambda self, model_name: dict(
+                      subject=self.subject, model_name=model_name))
     def form(self, model_name:str) -> None:
         """ caller """
 
@@ -306,12 +677,24 @@ class Formulate():
             raise ValueError(f"model_name {model_name} is not supported")
         
         # check count
-        print(f"\n({model_name}) | x: {x.shape}, y: {y.shape}")
-        a,b = np.unique(y, return_counts=True)
-        print(f"({model_name}) | unique: {[(i,v) for (i,v) in zip(a,b)]}")
-
-        # redundancy
-        x = x[:,:,:-1]
+        if log.isEnabledFor(logging.INFO):
+            a,b = np.unique(y, return_counts=True)
+            log.info(f"({model_name}) | x: {x.shape}, y: {y.shape}")
+            log.info(f"({model_name}) | unique: {[(i,v) for (i,v) in zip(a,b)]}")
+
+        # redundancy, quality screening, x/y are left as they are when
+        # nothing is rejected (both done before the covariances in form_cov)
+        if self._cov is None:
+            x = x[:,:,:-1]
+
+        if self.quality is not None and self._cov is None:
+            self.quality_masks, self.quality_report = screen(
+                x, channels=self.channels, **self.quality)
+            log.info(f"({model_name}) | quality: {self.quality_report}")
+            reject = self.quality_masks["reject"]
+            if reject.any():
+                keep = np.flatnonzero(~reject)
+                x, y = x[keep], y[keep]
         
         # encoder
         le = LabelEncoder()
@@ -321,7 +704,70 @@ class Formulate():
         # if len(a)==2:
         #     y = y.reshape(-1,1)
 
-        print(x.shape)
-        print(y.shape)
+        log.debug(f"({model_name}) | formed x: {x.shape}, y: {y.shape}")
+
+        return x, y, le
+
+    #-----------------------------------#
+    def form_cov(self, model_name:str, shrinkage = None):
+        """
+        form() with trial covariances instead of epochs: x is
+        (trials[, bands], channels, channels), see features.covariances
+        for <shrinkage> (None, float, "oas"). The covariances of a window
+        are computed in one batched pass and shared by every model using
+        it (e.g. 8c_mi, 8c_hand), on this instance and through the cache.
+        Usage:
+            covs, y, le = f.form_cov("4c_2class_hand", shrinkage="oas")
+            ref = features.mean_logeuclid(covs[train])
+            z = features.tangent_space(covs, ref)
+        """
+        self._cov = dict(shrinkage=shrinkage)
+        try:
+            return self.form(model_name)
+        finally:
+            self._cov = None
+
+
+    #-----------------------------------#
+    def form_many(self, model_names:list) -> dict:
+        """
+        Form several models from one extraction per superset of events.
+        The widest window needed by <model_names> is extracted once for
+        EVENT_IDX_4CLASS / EVENT_IDX_8CLASS, every model is then a slice
+        and label mask of it (a window whose trials the wide extraction
+        drops, e.g. near the end of a recording, is extracted on its own).
+        Usage:
+            d = f.form_many(["4c_rest", "4c_2class_hand", "8c_mi"])
+            x, y, le = d["4c_2class_hand"]
+        """
+
+        spans = {}
+        for model_name in model_names:
+            event_ids, intervals = self._windows(model_name)
+            key = tuple(event_ids)
+            if key in spans:
+                intervals = intervals + [spans[key][1]]
+            spans[key] = (event_ids, (min(i[0] for i in intervals),
+                                      max(i[1] for i in intervals)))
+
+        for event_ids, span in spans.values():
+            self._get(event_ids, span)
+
+        return {i: self.form(i) for i in model_names}
 
-        return x, y, le
\ No newline at end of file
+
+
+################################
+def form_subjects(dataset, subjects:list, model_names:list, n_jobs:int = 1, **kwargs) -> dict:
+    """
+    Formulate.form_many for several subjects, <n_jobs> subjects at a time
+    in a process pool. Results are returned in order of <subjects>.
+    Usage:
+        d = form_subjects(dataset, [12, 13, 14], ["4c_all", "8c_mi"], n_jobs=8,
+                          bandpass=[[8,13]], channels=("C3", "Cz", "C4"))
+        x, y, le = d[13]["8c_mi"]
+    """
+    out = Parallel(n_jobs=n_jobs)(
+        delayed(Formulate(dataset, subject=subject, **kwargs).form_many)(model_names) \
+            for subject in subjects)
+    return dict(zip(subjects, out))
@@ -0,0 +1,197 @@
+"""
+Cross-dataset harmonization into one EpochStore
+(common channels, sampling rate and label space)
+
+======================
+Authors: Cuong Pham
+cuongquocpham151@gmail.com
+
+"""
+import os
+import sys
+import copy
+import json
+import shutil
+import logging
+import mne
+from joblib import Parallel, delayed
+from moabb.paradigms import MotorImagery
+from store import EpochStore
+from cache import dataset_state
+
+
+# event names -> unified label (8c "<task>_r" trials are the same task)
+LABEL_ALIASES = dict(
+    right_hand_r="right_hand",
+    left_hand_r="left_hand",
+    right_foot_r="right_foot",
+    left_foot_r="left_foot",
+)
+
+log = logging.getLogger(__name__)
+
+
+#=========================#
+def dataset_channels(dataset, subject:int = None) -> list:
+    """
+    EEG channel names of <dataset>: EEG_CH_NAMES of its module when it is
+    a list, else the EEG channels of the first run of <subject> (default:
+    first of subject_list).
+    """
+    names = getattr(sys.modules.get(type(dataset).__module__), "EEG_CH_NAMES", None)
+    if isinstance(names, (list, tuple)):
+        return [i for i in names if not i.upper().startswith("EOG")]
+
+    if subject is None:
+        subject = dataset.subject_list[0]
+    data = dataset.get_data([subject])
+    raw = next(iter(next(iter(next(iter(data.values())).values())).values()))
+    return [raw.ch_names[i] for i in mne.pick_types(raw.info, eeg=True)]
+
+
+#=========================#
+def common_channels(datasets:dict, channels:list = None, subjects:dict = None) -> tuple:
+    """
+    Channels shared by all <datasets> {name: dataset} (case-insensitive),
+    in the order of the first dataset (or of <channels>). <subjects>
+    {name: [subject, ...]}: subjects to read the channels from.
+    Return (channels, {name: [channel name in that dataset]}).
+    """
+    subjects = subjects or {}
+    names = {k: dataset_channels(d, *subjects.get(k, [])[:1]) for k, d in datasets.items()}
+    upper = {k: {i.upper(): i for i in v} for k, v in names.items()}
+    if channels is None:
+        channels = next(iter(names.values()))
+    channels = [i for i in channels if all(i.upper() in u for u in upper.values())]
+    if not channels:
+        raise ValueError("no channel common to all datasets")
+    return channels, {k: [u[i.upper()] for i in channels] for k, u in upper.items()}
+
+
+#=========================#
+def unify_labels(event_id:dict, mapping:dict = None, labels:list = None) -> dict:
+    """ {event name: unified label} of <event_id>, restricted to <labels> """
+
+    mapping = {**LABEL_ALIASES, **(mapping or {})}
+    out = {k: mapping.get(k, k) for k in event_id}
+    return {k: v for k, v in out.items() if labels is None or v in labels}
+
+
+#=========================#
+def _write(store, name, code, dataset, subject, channels, events, config):
+    """ extract one subject of one dataset and write its shard """
+
+    paradigm = MotorImagery(
+        events=list(events),
+        n_classes=len(events),
+        fmin=config["fmin"],
+        fmax=config["fmax"],
+        tmin=config["tmin"],
+        tmax=config["tmax"],
+        channels=channels,
+        resample=config["fs"],
+    )
+    x, y, metadata = paradigm.get_data(dataset=dataset, subjects=[subject])
+
+    # epochs resampled from different rates differ by one sample
+    n_times = int(round((config["tmax"] - config["tmin"]) * config["fs"]))
+    x = x[..., :n_times]
+    y = [events[i] for i in y]
+    store.add(name, x, y, metadata, dataset=code, reindex=False)
+
+
+#=========================#
+def harmonize(
+    datasets:dict,
+    root:str,
+    fs:float = 128,
+    tmin:float = 0,
+    tmax:float = 2,
+    fmin:float = 8,
+    fmax:float = 30,
+    channels:list = None,
+    mapping:dict = None,
+    labels:list = None,
+    subjects:dict = None,
+    n_jobs:int = 1,
+) -> dict:
+    """
+    Write every subject of every dataset to one EpochStore, in a single
+    parallel pass over (dataset, subject). <subjects> {name: [subject, ...]}
+    restricts a dataset to some subjects (e.g. the Flex subjects on disk).
+    A failing (dataset, subject) is reported and retried next time, the
+    others are written. Epochs share the same channels (intersection),
+    sampling rate <fs>, window <tmin>-<tmax> (s after each dataset's cue,
+    (tmax-tmin)*fs samples) and label names (event names through
+    LABEL_ALIASES and <mapping>, kept if in <labels>). Datasets with a
+    fs_resample option are decimated while loading.
+
+    Shards already in <root> are reused when the settings did not change
+    (including each dataset's public attributes, e.g. Flex protocol/run,
+    Bk2019 sessions), so later experiments only open the store.
+    Return {"added": [...], "failed": [...], "unchanged": n} (shard names).
+
+    Usage:
+        report = harmonize(
+            dict(bciiv2a=BCIIV2a_moabb(), physionet=PhysionetMI_moabb(),
+                 bk2019=Bk2019_moabb(), flex2023=Flex2023_moabb(...)),
+            "/home/pham/bci/STORE/pooled", fs=128, n_jobs=16,
+            mapping=dict(right_foot="feet", left_foot="feet"),
+            labels=["left_hand", "right_hand", "feet"],
+            subjects=dict(flex2023=list(range(12, 40))))
+        data = EpochDataset(EpochStore("/home/pham/bci/STORE/pooled"),
+                            datasets=["cho2017", "physionet"])
+    """
+    subjects = subjects or {}
+    channels, ch_maps = common_channels(datasets, channels, subjects)
+    config = dict(
+        fs=fs, tmin=tmin, tmax=tmax, fmin=fmin, fmax=fmax, channels=channels,
+        mapping=mapping, labels=labels,
+        datasets={k: dict(type=type(d).__name__, state=dataset_state(d)) \
+            for k, d in datasets.items()},
+    )
+    config = json.loads(json.dumps(config, default=str))
+
+    # settings changed -> start over
+    path_config = os.path.join(root, "harmonize.json")
+    if os.path.isfile(path_config):
+        with open(path_config, "r") as fid:
+            if json.load(fid) != config:
+                shutil.rmtree(root)
+    store = EpochStore(root)
+    with open(path_config, "w") as fid:
+        json.dump(config, fid)
+
+    done = set(os.listdir(os.path.join(root, "shards")))
+    report = dict(added=[], failed=[], unchanged=0)
+    tasks = []
+    for code, dataset in datasets.items():
+        events = unify_labels(dataset.event_id, mapping, labels)
+        if not events:
+            continue
+        if getattr(dataset, "fs_resample", 0) is None:
+            dataset = copy.copy(dataset)
+            dataset.fs_resample = fs
+        for subject in subjects.get(code, dataset.subject_list):
+            name = f"{code}-sub-{subject:03d}"
+            if name in done:
+                report["unchanged"] += 1
+            else:
+                tasks.append((name, code, dataset, subject, ch_maps[code], events))
+
+    def run(task):
+        try:
+            _write(store, *task, config)
+            return True
+        except Exception as e: # retried next time
+            log.warning(f"{task[0]}: {e!r}")
+            return False
+
+    out = Parallel(n_jobs=n_jobs)(delayed(run)(task) for task in tasks)
+    for task, ok in zip(tasks, out):
+        report["added" if ok else "failed"].append(task[0])
+    store.reindex()
+
+    log.info(f"harmonize {root} | " + \
+             ", ".join(f"{k}: {v if isinstance(v, int) else len(v)}" for k, v in report.items()))
+    return report
@@ -0,0 +1,201 @@
+"""
+Incremental ingestion of Flex2023 recordings into an EpochStore
+
+Each F<subject>_<protocol>_<session>_<run>.edf becomes one shard of the
+store. A manifest of the processed EDFs (size, mtime, sha1) is kept next
+to the shards, so a nightly run only decodes new or changed files and
+drops the shards of deleted ones.
+
+Usage:
+    python ingest.py /home/pham/bci/DATASET/FLEX /home/pham/bci/STORE/flex \\
+        --protocols 8c 4c --bandpass 8,13 13,30 --n-jobs 8
+
+======================
+Authors: Cuong Pham
+cuongquocpham151@gmail.com
+
+"""
+import os
+import re
+import copy
+import json
+import hashlib
+import logging
+import argparse
+from joblib import Parallel, delayed
+from config import *
+from flex2023 import Flex2023_moabb
+from formulate import Formulate
+from store import EpochStore
+
+MANIFEST_FILE = "ingest.json" # in the store root
+
+# epoch span per protocol, covering every Formulate model window
+WINDOWS = {"4c": (-4, 2), "8c": (0, 4.5)}
+
+log = logging.getLogger(__name__)
+
+
+#=========================#
+def fingerprint(path:str, chunk:int = 2**20) -> str:
+    """ sha1 of the content of <path> """
+
+    h = hashlib.sha1()
+    with open(path, "rb") as fid:
+        for block in iter(lambda: fid.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def parse_name(path:str):
+    """ F12_8c_ss1_run1.edf -> (12, "8c", "ss1", "run1"), None if not a run """
+
+    m = re.fullmatch(r"F(\d+)_([^_]+)_([^_]+)_([^_]+)\.edf", os.path.basename(path))
+    if m is None:
+        return None
+    return int(m.group(1)), m.group(2), m.group(3), m.group(4)
+
+
+#=========================#
+def _ingest_one(store, dataset, path, subject, protocol, session, run, config):
+    """ epochs of one edf -> shard, return the shard name and epoch count """
+
+    dataset = copy.copy(dataset)
+    dataset.protocol = protocol
+    dataset.session = session
+    dataset.run = os.path.basename(path) # selects exactly this edf
+    event_ids = EVENT_IDX_4CLASS if "4c" in protocol else EVENT_IDX_8CLASS
+
+    f = Formulate(dataset, subject=subject, **config["formulate"])
+    x, y = f.epochs(event_ids, config["windows"]["4c" if "4c" in protocol else "8c"])
+
+    name = os.path.basename(path)[:-len(".edf")]
+    store.add(name, x, y, subject=subject, session=session, run=run,
+              dataset=f"flex2023-{protocol}", reindex=False)
+    return name, len(y)
+
+
+#=========================#
+def ingest(
+    dataset:Flex2023_moabb,
+    root:str,
+    protocols:list = None,
+    windows:dict = None,
+    n_jobs:int = 1,
+    **kwargs,
+) -> dict:
+    """
+    Bring EpochStore <root> up to date with the EDFs of <dataset>.dir_raw_data.
+    Files whose size/mtime did not change are skipped without reading them,
+    the others are hashed and only processed when their content is new.
+    <protocols>: e.g. ["8c"], all when None. <windows>: see WINDOWS.
+    <kwargs> go to Formulate (bandpass, channels, native_epochs, dtype, ...);
+    changing them (or <windows>) reprocesses every file.
+    Return {"added": [...], "changed": [...], "removed": [...], "failed": [...],
+            "unchanged": n}.
+
+    Usage:
+        dataset = Flex2023_moabb(dir_raw_data="/home/pham/bci/DATASET/FLEX")
+        report = ingest(dataset, "/home/pham/bci/STORE/flex", protocols=["8c"],
+                        bandpass=[[8,13]], channels=("C3", "Cz", "C4"), n_jobs=8)
+        data = EpochDataset(EpochStore("/home/pham/bci/STORE/flex"),
+                            datasets=["flex2023-8c"])
+    """
+    store = EpochStore(root)
+    config = json.loads(json.dumps(dict(
+        windows={**WINDOWS, **(windows or {})}, formulate=kwargs, fs=FS)))
+
+    path_manifest = os.path.join(root, MANIFEST_FILE)
+    try:
+        with open(path_manifest, "r") as fid:
+            manifest = json.load(fid)
+    except (OSError, ValueError):
+        manifest = {}
+    files = manifest.get("files", {}) if manifest.get("config") == config else {}
+
+    # new or changed edfs
+    report = dict(added=[], changed=[], removed=[], failed=[], unchanged=0)
+    current, tasks = {}, []
+    for subject, paths in sorted(dataset.get_index(refresh=True)["subjects"].items()):
+        for path in paths:
+            parsed = parse_name(path)
+            if parsed is None or (protocols is not None and parsed[1] not in protocols):
+                continue
+            st = os.stat(path)
+            entry = files.get(path)
+            if entry and (entry["size"], entry["mtime"]) == (st.st_size, st.st_mtime_ns):
+                current[path] = entry
+                report["unchanged"] += 1
+                continue
+            sha1 = fingerprint(path)
+            if entry and entry["sha1"] == sha1: # touched only
+                current[path] = {**entry, "size": st.st_size, "mtime": st.st_mtime_ns}
+                report["unchanged"] += 1
+                continue
+            report["changed" if entry else "added"].append(path)
+            current[path] = dict(size=st.st_size, mtime=st.st_mtime_ns, sha1=sha1)
+            tasks.append((path, *parsed))
+
+    def run(task):
+        try:
+            return _ingest_one(store, dataset, *task, config)
+        except Exception as e: # retried next time
+            log.warning(f"{task[0]}: {e!r}")
+            return None
+
+    out = Parallel(n_jobs=n_jobs)(delayed(run)(task) for task in tasks)
+    for task, result in zip(tasks, out):
+        if result is None:
+            report["failed"].append(task[0])
+            current.pop(task[0])
+        else:
+            current[task[0]].update(shard=result[0], n_epochs=result[1])
+
+    # shards of deleted edfs, or of all edfs when the settings changed
+    keep = {i["shard"] for i in current.values()}
+    for path, entry in manifest.get("files", {}).items():
+        if entry["shard"] not in keep:
+            store.remove(entry["shard"], reindex=False)
+            if path not in current:
+                report["removed"].append(path)
+
+    store.reindex()
+    tmp = f"{path_manifest}.tmp{os.getpid()}"
+    with open(tmp, "w") as fid:
+        json.dump(dict(config=config, files=current), fid)
+    os.replace(tmp, path_manifest)
+
+    log.info(f"ingest {root} | " + \
+             ", ".join(f"{k}: {v if isinstance(v, int) else len(v)}" for k, v in report.items()))
+    return report
+
+
+#=========================#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("dir_raw_data")
+    parser.add_argument("root", help="EpochStore folder")
+    parser.add_argument("--protocols", nargs="+", default=None)
+    parser.add_argument("--bandpass", nargs="+", default=["8,13"],
+                        help="bands as low,high (Hz)")
+    parser.add_argument("--channels", nargs="+", default=["C3", "Cz", "C4"])
+    parser.add_argument("--native-epochs", action="store_true")
+    parser.add_argument("--dtype", default=None)
+    parser.add_argument("--n-jobs", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    report = ingest(
+        Flex2023_moabb(dir_raw_data=args.dir_raw_data), args.root,
+        protocols=args.protocols,
+        n_jobs=args.n_jobs,
+        bandpass=[[float(i) for i in band.split(",")] for band in args.bandpass],
+        channels=args.channels,
+        native_epochs=args.native_epochs,
+        dtype=args.dtype,
+    )
+    print(json.dumps(report, indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Opt-in timing / peak memory instrumentation of the loaders and Formulate
+
+======================
+Authors: Cuong Pham
+cuongquocpham151@gmail.com
+
+"""
+import os
+import json
+import time
+import logging
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+
+_SINKS = [] # instrumentation is off while empty
+_MEMORY = False
+_LOCAL = threading.local() # per-thread stack of open spans
+
+
+################################
+class MemorySink():
+    """ keep records in self.records """
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def summary(self) -> dict:
+        """ {name: {"n": calls, "seconds": total, "peak_bytes": max}} """
+        out = {}
+        for r in self.records:
+            s = out.setdefault(r["name"], dict(n=0, seconds=0.0, peak_bytes=None))
+            s["n"] += 1
+            s["seconds"] += r["seconds"]
+            if r["peak_bytes"] is not None:
+                s["peak_bytes"] = max(s["peak_bytes"] or 0, r["peak_bytes"])
+        return out
+
+
+class LoggerSink():
+    """ one log line per record """
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger("instrument")
+        self.level = level
+
+    def __call__(self, record):
+        peak = "" if record["peak_bytes"] is None else \
+            f" | peak {record['peak_bytes'] / 2**20:.1f}MB"
+        self.logger.log(self.level, f"{'  ' * record['depth']}{record['name']} "
+                                    f"| {record['seconds']:.3f}s{peak}")
+
+
+class JsonlSink():
+    """ append records to a JSON lines file """
+    def __init__(self, path:str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock, open(self.path, "a") as fid:
+            fid.write(line)
+
+
+#=========================#
+def enable(*sinks, memory:bool = False) -> None:
+    """
+    Start sending span records to <sinks> (callables taking a dict).
+    <memory>: also measure peak python/numpy allocations of each span
+    with tracemalloc (slows allocation-heavy code down).
+    Spans in joblib worker processes are not recorded.
+    Usage:
+        sink = MemorySink()
+        enable(sink, JsonlSink("trace.jsonl"), memory=True)
+        x, y, le = Formulate(dataset, subject=12).form("8c_rest")
+        disable()
+        print(sink.summary())
+    """
+    global _MEMORY
+    _SINKS[:] = sinks
+    _MEMORY = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable() -> None:
+    global _MEMORY
+    _SINKS.clear()
+    if _MEMORY and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _MEMORY = False
+
+
+def enabled() -> bool:
+    return bool(_SINKS)
+
+
+#=========================#
+@contextmanager
+def span(name:str, **fields):
+    """
+    Time the enclosed block (and its peak memory) as one record
+        {"name", "seconds", "peak_bytes", "start", "depth", "parent", "pid", **fields}
+    No-op when instrumentation is disabled.
+    """
+    if not _SINKS:
+        yield
+        return
+
+    stack = getattr(_LOCAL, "stack", None)
+    if stack is None:
+        stack = _LOCAL.stack = []
+    memory = _MEMORY and tracemalloc.is_tracing()
+    if memory:
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1]["mem"][1] = max(stack[-1]["mem"][1], peak)
+        tracemalloc.reset_peak()
+    entry = dict(name=name, mem=[current, current] if memory else None)
+    parent = stack[-1]["name"] if stack else None
+    stack.append(entry)
+
+    start = time.time()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - t0
+        stack.pop()
+        peak_bytes = None
+        if memory:
+            _, peak = tracemalloc.get_traced_memory()
+            entry["mem"][1] = max(entry["mem"][1], peak)
+            peak_bytes = entry["mem"][1] - entry["mem"][0]
+            if stack:
+                stack[-1]["mem"][1] = max(stack[-1]["mem"][1], entry["mem"][1])
+
+        record = dict(name=name, seconds=seconds, peak_bytes=peak_bytes, start=start,
+                      depth=len(stack), parent=parent, pid=os.getpid(), **fields)
+        for sink in _SINKS:
+            sink(record)
+
+
+def instrumented(name:str, fields=None):
+    """
+    Decorator, run the function inside span(<name>, **fields(*args, **kwargs)).
+    Usage:
+        @instrumented("formulate.form", lambda self, model_name: dict(model_name=model_name))
+        def form(self, model_name): ...
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _SINKS:
+                return func(*args, **kwargs)
+            extra = fields(*args, **kwargs) if fields is not None else {}
+            with span(name, **extra):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,81 @@
+"""
+Vectorized epoch quality screening (peak-to-peak, flatline, variance)
+
+======================
+Authors: Cuong Pham
+cuongquocpham151@gmail.com
+
+"""
+import numpy as np
+
+
+#=========================#
+def trial_stats(x, chunk_bytes:int = 2**20):
+    """
+    Peak-to-peak and variance over time of every trial/channel of <x>
+    (trials, channels, times[, bands]) -> 2 arrays (trials, channels[, bands]).
+    Trials are taken by chunks of ~<chunk_bytes>, so that min/max/var read
+    them from cache rather than memory.
+    """
+    x = np.asarray(x)
+    chunk = max(1, chunk_bytes // max(x[0].nbytes, 1)) if len(x) else 1
+    shape = x.shape[:2] + x.shape[3:]
+    ptp = np.empty(shape)
+    var = np.empty(shape)
+    for i in range(0, len(x), chunk):
+        c = x[i:i+chunk]
+        np.subtract(c.max(axis=2), c.min(axis=2), out=ptp[i:i+chunk])
+        var[i:i+chunk] = c.var(axis=2)
+    return ptp, var
+
+
+#=========================#
+def screen(x, ptp:float = None, flat:float = None, var_z:float = None,
+           max_bad_channels:int = 0, channels:list = None):
+    """
+    Flag bad trials of <x> (trials, channels, times[, bands]), in the unit
+    of x (uV for MOABB/Formulate output). A trial/channel is bad if its
+        ptp:   peak-to-peak > <ptp>
+        flat:  peak-to-peak < <flat> (flatline)
+        var:   |robust z| of its log variance, among all trials of that
+               channel (median/MAD), > <var_z>
+    in any band. Criteria left None are skipped. A trial is rejected when
+    more than <max_bad_channels> of its channels are bad.
+
+    Return masks {"ptp", "flat", "var": (trials, channels), "reject": (trials,)}
+    and a report {"n_trials", "n_rejected", "ptp"/"flat"/"var": trials
+    flagged, "channels": {channel: trials flagged}}.
+
+    Usage:
+        masks, report = screen(x, ptp=150, flat=0.5, var_z=5)
+        x, y = x[~masks["reject"]], y[~masks["reject"]]
+    """
+    p2p, var = trial_stats(x)
+    extra = tuple(range(2, p2p.ndim)) # bands
+    n_trials, n_chans = p2p.shape[:2]
+
+    masks = {}
+    if ptp is not None:
+        masks["ptp"] = (p2p > ptp).any(axis=extra)
+    if flat is not None:
+        masks["flat"] = (p2p < flat).any(axis=extra)
+    if var_z is not None:
+        log_var = np.log(np.maximum(var, np.finfo(float).tiny))
+        median = np.median(log_var, axis=0)
+        mad = np.median(np.abs(log_var - median), axis=0) * 1.4826
+        z = np.abs(log_var - median) / np.maximum(mad, np.finfo(float).eps)
+        masks["var"] = (z > var_z).any(axis=extra)
+
+    bad = np.zeros((n_trials, n_chans), dtype=bool)
+    for mask in masks.values():
+        bad |= mask
+    masks["reject"] = bad.sum(axis=1) > max_bad_channels
+
+    names = list(channels) if channels is not None else list(range(n_chans))
+    report = dict(
+        n_trials=n_trials,
+        n_rejected=int(masks["reject"].sum()),
+        **{k: int(v.any(axis=1).sum()) for k, v in masks.items() if k != "reject"},
+        channels={ch: int(n) for ch, n in zip(names, bad.sum(axis=0))},
+    )
+    return masks, report
@@ -0,0 +1,276 @@
+"""
+Shared-memory epoch server for multi-process training workers
+
+The server forms each (subject, model_name) once with Formulate and
+publishes x/y as .npy files in shared memory (/dev/shm, tmpfs). Workers
+ask for a handle over a local connection and memory-map zero-copy views.
+Files are reference counted per worker and deleted when the last one
+releases them (or disconnects), except preloaded ones, which the server
+keeps until evict() or close().
+(.npy on tmpfs rather than multiprocessing.shared_memory, whose resource
+tracker unlinks blocks when the attaching processes exit, python < 3.13)
+
+Protocol (multiprocessing.connection, pickled tuples):
+    ("get", subject, model_name)     -> ("ok", handle) | ("error", repr)
+    ("release", subject, model_name) -> ("ok", refcount)
+    handle = dict(key=(subject, model_name), x=path.npy, y=path.npy, classes=[...])
+
+======================
+Authors: Cuong Pham
+cuongquocpham151@gmail.com
+
+"""
+import os
+import shutil
+import logging
+import tempfile
+import threading
+import numpy as np
+from multiprocessing.connection import Listener, Client
+from sklearn.preprocessing import LabelEncoder
+from formulate import Formulate, form_subjects
+
+log = logging.getLogger(__name__)
+
+
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None # None: default temp folder
+
+
+#=========================#
+def _share(array, path:str) -> str:
+    """ write <array> to <path> (.npy, atomic) """
+
+    tmp = f"{path}.tmp.npy"
+    np.save(tmp, np.asarray(array))
+    os.replace(tmp, path)
+    return path
+
+
+def _attach(path:str):
+    """ read-only zero-copy view of a shared .npy """
+    return np.load(path, mmap_mode="r")
+
+
+################################
+class EpochServer():
+    """
+    Serve Formulate outputs from shared memory to local worker processes.
+    <kwargs> go to Formulate (bandpass, channels, cache, native_epochs, dtype, ...).
+
+    Usage:
+        with EpochServer(dataset, bandpass=[[8,13]], cache=EpochCache(...)) as server:
+            server.preload([12, 13, 14], ["4c_all", "8c_mi"], n_jobs=3) # optional, kept
+            Parallel(n_jobs=8)(delayed(train)(server.connection, params) for params in grid)
+
+        def train(connection, params):
+            with EpochClient(*connection) as client:
+                x, y, le = client.get(13, "8c_mi") # read-only, zero copy
+                ...
+    """
+    def __init__(self, dataset, address=("127.0.0.1", 0), **kwargs):
+        self.dataset = dataset
+        self.kwargs = kwargs
+        self.root = tempfile.mkdtemp(prefix="epoch-server-", dir=SHM_DIR)
+        self._blocks = {} # {key: handle}
+        self._refs = {} # {key: count}
+        self._pinned = set() # preloaded keys, freed by evict()/close() only
+        self._lock = threading.Lock()
+        self._loading = {} # {key: Lock}, one Formulate run per key
+        self._authkey = os.urandom(16)
+        self._listener = Listener(address, authkey=self._authkey)
+        self._closed = False
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+
+    @property
+    def connection(self) -> tuple:
+        """ (address, authkey) to pass to EpochClient """
+        return self._listener.address, self._authkey
+
+    @property
+    def stats(self) -> dict:
+        """ {key: refcount}, preloaded keys and shared bytes """
+        with self._lock:
+            return dict(refs={k: self._refs.get(k, 0) for k in self._blocks},
+                        pinned=sorted(self._pinned),
+                        bytes=sum(os.path.getsize(h[i]) for h in self._blocks.values() \
+                            for i in ("x", "y")))
+
+    #-----------------------------------#
+    def _publish(self, key, x, y, le, refs:int = 0, pin:bool = False):
+        """ write x/y and register them with <refs> references, atomically """
+
+        name = os.path.join(self.root, f"sub-{key[0]}-{key[1]}")
+        handle = dict(key=key, x=_share(x, f"{name}-x.npy"), y=_share(y, f"{name}-y.npy"),
+                      classes=le.classes_.tolist())
+        with self._lock:
+            self._blocks[key] = handle
+            self._refs[key] = self._refs.get(key, 0) + refs
+            if pin:
+                self._pinned.add(key)
+        return handle
+
+    def preload(self, subjects:list, model_names:list, n_jobs:int = 1) -> None:
+        """
+        Form and publish <model_names> of <subjects> (form_subjects) before
+        workers start. These stay shared at refcount 0 until evict()/close().
+        """
+
+        todo = [s for s in subjects if any((s, m) not in self._blocks for m in model_names)]
+        out = form_subjects(self.dataset, todo, model_names, n_jobs=n_jobs, **self.kwargs)
+        for subject, models in out.items():
+            for model_name, (x, y, le) in models.items():
+                key = (subject, model_name)
+                if key in self._blocks:
+                    with self._lock:
+                        self._pinned.add(key)
+                else:
+                    self._publish(key, x, y, le, pin=True)
+
+    def acquire(self, subject, model_name) -> dict:
+        """ handle of (subject, model_name), formed on first use, refcount + 1 """
+
+        key = (subject, model_name)
+        with self._lock:
+            loading = self._loading.setdefault(key, threading.Lock())
+        with loading:
+            # checked and counted together, release() cannot free it in between
+            with self._lock:
+                if key in self._blocks:
+                    self._refs[key] += 1
+                    return self._blocks[key]
+            x, y, le = Formulate(self.dataset, subject=subject, **self.kwargs).form(model_name)
+            return self._publish(key, x, y, le, refs=1)
+
+    def release(self, subject, model_name) -> int:
+        """ refcount - 1, delete the files at 0 unless preloaded """
+
+        key = (subject, model_name)
+        with self._lock:
+            if key not in self._refs:
+                return 0
+            self._refs[key] = count = max(self._refs[key] - 1, 0)
+            if count == 0 and key not in self._pinned:
+                self._free(key)
+            return count
+
+    def evict(self, subject, model_name) -> None:
+        """ unpin a preloaded entry, deleted now or at its last release """
+
+        key = (subject, model_name)
+        with self._lock:
+            self._pinned.discard(key)
+            if self._refs.get(key, 0) == 0:
+                self._free(key)
+
+    def _free(self, key):
+        # workers still mapping them keep their pages until they drop the views
+        handle = self._blocks.pop(key, None)
+        if handle is not None:
+            for i in ("x", "y"):
+                os.remove(handle[i])
+        self._refs.pop(key, None)
+
+    #-----------------------------------#
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError):
+                if self._closed:
+                    return
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        """ one worker, its references are released when it disconnects """
+
+        held = []
+        try:
+            while True:
+                op, subject, model_name = conn.recv()
+                try:
+                    if op == "get":
+                        reply = ("ok", self.acquire(subject, model_name))
+                        held.append((subject, model_name))
+                    elif op == "release":
+                        if (subject, model_name) in held:
+                            held.remove((subject, model_name))
+                        reply = ("ok", self.release(subject, model_name))
+                    else:
+                        reply = ("error", f"unknown op {op!r}")
+                except Exception as e:
+                    reply = ("error", repr(e))
+                conn.send(reply)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+            for key in held:
+                self.release(*key)
+            if held:
+                log.debug(f"worker disconnected, released {held}")
+
+    def close(self) -> None:
+        """ stop serving and delete every file """
+
+        self._closed = True
+        self._listener.close()
+        with self._lock:
+            self._blocks.clear()
+            self._refs.clear()
+            self._pinned.clear()
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+################################
+class EpochClient():
+    """
+    Worker side of EpochServer, see EpochServer.
+    Views returned by get() stay valid after release()/close(), their
+    memory is freed once the last view is dropped.
+    """
+    def __init__(self, address, authkey:bytes):
+        self._conn = Client(address, authkey=authkey)
+        self._held = [] # keys of get() not released yet
+
+    def _call(self, *msg):
+        self._conn.send(msg)
+        status, value = self._conn.recv()
+        if status != "ok":
+            raise RuntimeError(value)
+        return value
+
+    def get(self, subject, model_name):
+        """ (x, y, le) of Formulate.form(model_name) for <subject>, read-only views """
+
+        handle = self._call("get", subject, model_name)
+        x, y = _attach(handle["x"]), _attach(handle["y"])
+        self._held.append((subject, model_name))
+        le = LabelEncoder()
+        le.classes_ = np.array(handle["classes"])
+        return x, y, le
+
+    def release(self, subject, model_name) -> None:
+        """ detach one get() of (subject, model_name) """
+
+        if (subject, model_name) in self._held:
+            self._held.remove((subject, model_name))
+            self._call("release", subject, model_name)
+
+    def close(self) -> None:
+        for key in list(self._held):
+            self.release(*key)
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,210 @@
+"""
+Memory-mapped epoch store for out-of-core training
+
+======================
+Authors: Cuong Pham
+cuongquocpham151@gmail.com
+
+"""
+import os
+import json
+import shutil
+import numpy as np
+from joblib import Parallel, delayed
+
+
+INDEX_DTYPE = np.dtype([
+    ("shard", "<u2"),
+    ("row", "<u4"),
+    ("dataset", "<u2"),
+    ("subject", "<i4"),
+    ("session", "<u2"),
+    ("run", "<u2"),
+    ("label", "<u2"),
+])
+
+
+################################
+class EpochStore():
+    """
+    Epochs of a whole corpus as per-shard (usually per-subject) x.npy
+    files, plus one compact index of every epoch:
+        <root>/shards/<name>/x.npy    (n, channels, times[, bands])
+        <root>/shards/<name>/meta.npy (dataset, subject, session, run, label) per epoch
+        <root>/index.npy              INDEX_DTYPE records
+        <root>/index.json             shard names/shapes, dataset/session/run/label names
+
+    Usage:
+        store = EpochStore("/home/pham/bci/STORE/physionet")
+        store.build(dataset, dataset.subject_list, paradigm, n_jobs=8)
+        data = EpochDataset(store)
+        x, y = data.get_batch(np.arange(64))
+    """
+    def __init__(self, root:str):
+        self.root = root
+        self._info = None
+        self._index = None
+        os.makedirs(os.path.join(self.root, "shards"), exist_ok=True)
+
+    #-----------------------------------#
+    def add(self, name:str, x, y, metadata=None, subject:int=-1,
+            session:str="", run:str="", dataset:str="", reindex:bool=True) -> None:
+        """
+        Write shard <name>. Subject/session/run come from MOABB <metadata>
+        (DataFrame) when given, else from the arguments for all epochs.
+        """
+        n = len(y)
+        if metadata is not None:
+            subject = np.asarray(metadata["subject"], dtype=np.int32)
+            session = np.asarray(metadata["session"], dtype=str)
+            run = np.asarray(metadata["run"], dtype=str)
+        meta = np.rec.fromarrays([
+            np.broadcast_to(np.asarray(dataset, dtype=str), n),
+            np.broadcast_to(np.asarray(subject, dtype=np.int32), n),
+            np.broadcast_to(np.asarray(session, dtype=str), n),
+            np.broadcast_to(np.asarray(run, dtype=str), n),
+            np.asarray(y, dtype=str),
+        ], names=["dataset", "subject", "session", "run", "label"])
+
+        path = os.path.join(self.root, "shards", name)
+        tmp = f"{path}.tmp{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+        np.save(os.path.join(tmp, "x.npy"), np.asarray(x))
+        np.save(os.path.join(tmp, "meta.npy"), meta)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+
+        if reindex:
+            self.reindex()
+
+    #-----------------------------------#
+    def remove(self, name:str, reindex:bool=True) -> None:
+        """ Delete shard <name> (if any) """
+
+        shutil.rmtree(os.path.join(self.root, "shards", name), ignore_errors=True)
+        if reindex:
+            self.reindex()
+
+    #-----------------------------------#
+    def build(self, dataset, subjects:list, paradigm, n_jobs:int = 1) -> None:
+        """ One shard "sub-<subject>" per subject from <paradigm>.get_data(), in parallel """
+
+        def write(subject):
+            x, y, metadata = paradigm.get_data(dataset=dataset, subjects=[subject])
+            self.add(f"sub-{subject:03d}", x, y, metadata, reindex=False)
+
+        Parallel(n_jobs=n_jobs)(delayed(write)(subject) for subject in subjects)
+        self.reindex()
+
+    #-----------------------------------#
+    def reindex(self) -> None:
+        """ Rebuild index.npy/index.json from the shards on disk """
+
+        names = sorted(i for i in os.listdir(os.path.join(self.root, "shards")) \
+            if ".tmp" not in i)
+        metas = [np.load(os.path.join(self.root, "shards", i, "meta.npy")) for i in names]
+        shapes = [np.load(os.path.join(self.root, "shards", i, "x.npy"), mmap_mode="r").shape \
+            for i in names]
+
+        meta = np.concatenate(metas) if metas else \
+            np.rec.fromarrays([[], [], [], [], []],
+                names=["dataset", "subject", "session", "run", "label"])
+        index = np.empty(len(meta), dtype=INDEX_DTYPE)
+        index["shard"] = np.repeat(np.arange(len(names)), [len(i) for i in metas])
+        index["row"] = np.concatenate([np.arange(len(i)) for i in metas]) if metas else []
+        index["subject"] = meta["subject"]
+        info = dict(shards=[dict(name=i, shape=list(s)) for i, s in zip(names, shapes)])
+        for field in ("dataset", "session", "run", "label"):
+            info[f"{field}s"], index[field] = np.unique(meta[field], return_inverse=True)
+            info[f"{field}s"] = info[f"{field}s"].tolist()
+
+        np.save(os.path.join(self.root, "index.npy"), index)
+        with open(os.path.join(self.root, "index.json"), "w") as fid:
+            json.dump(info, fid)
+        self._info, self._index = info, index
+
+    #-----------------------------------#
+    @property
+    def info(self) -> dict:
+        if self._info is None:
+            with open(os.path.join(self.root, "index.json"), "r") as fid:
+                self._info = json.load(fid)
+        return self._info
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = np.load(os.path.join(self.root, "index.npy"))
+        return self._index
+
+    def shard(self, i:int):
+        """ x of shard <i>, memory-mapped """
+        name = self.info["shards"][i]["name"]
+        return np.load(os.path.join(self.root, "shards", name, "x.npy"), mmap_mode="r")
+
+
+
+################################
+class EpochDataset():
+    """
+    Lazy view of an EpochStore, epochs are read from the memory-mapped
+    shards on access. <subjects>/<labels>/<sessions>/<datasets> restrict the epochs,
+    y is the position of the label in <labels> (or store.info["labels"]).
+
+    Usage:
+        data = EpochDataset(store, subjects=range(1, 90), labels=["left_hand", "right_hand"])
+        for idx in np.array_split(np.random.permutation(len(data)), 100):
+            x, y = data.get_batch(idx)
+    """
+    def __init__(self, store:EpochStore, subjects=None, labels=None, sessions=None,
+                 datasets=None):
+        self.store = store
+        info, index = store.info, store.index
+        self.labels = list(labels) if labels is not None else list(info["labels"])
+
+        mask = np.isin(np.array(info["labels"])[index["label"]], self.labels)
+        if subjects is not None:
+            mask &= np.isin(index["subject"], list(subjects))
+        if sessions is not None:
+            mask &= np.isin(np.array(info["sessions"])[index["session"]], list(sessions))
+        if datasets is not None:
+            mask &= np.isin(np.array(info["datasets"])[index["dataset"]], list(datasets))
+        self.index = index[mask]
+
+        # store label code -> dataset label
+        lut = np.full(len(info["labels"]), -1, dtype=np.int64)
+        for i, name in enumerate(info["labels"]):
+            if name in self.labels:
+                lut[i] = self.labels.index(name)
+        self.y = lut[self.index["label"]]
+        self._shards = {}
+
+    def _shard(self, i):
+        if i not in self._shards:
+            self._shards[i] = self.store.shard(i)
+        return self._shards[i]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        rec = self.index[i]
+        return np.asarray(self._shard(int(rec["shard"]))[rec["row"]]), self.y[i]
+
+    def get_batch(self, indices):
+        """ (x, y) of <indices>, one sorted read per shard """
+
+        indices = np.asarray(indices)
+        rec = self.index[indices]
+        x = None
+        for shard in np.unique(rec["shard"]):
+            pos = np.flatnonzero(rec["shard"] == shard)
+            rows = rec["row"][pos]
+            order = np.argsort(rows, kind="stable")
+            data = self._shard(int(shard))[rows[order]]
+            if x is None:
+                x = np.empty((len(indices),) + data.shape[1:], dtype=data.dtype)
+            x[pos[order]] = data
+        if x is None:
+            x = np.empty((0,) + tuple(self.store.info["shards"][0]["shape"][1:]))
+        return x, self.y[indices]
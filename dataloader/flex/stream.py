@@ -0,0 +1,273 @@
+"""
+Real-time epoching for FLEX DATASET (EMOTIV FLEX sample blocks)
+
+======================
+Authors: Cuong Pham
+cuongquocpham151@gmail.com
+
+"""
+import time
+import socket
+import struct
+import threading
+import numpy as np
+import mne
+from scipy.signal import butter, iirnotch, sosfilt, sosfilt_zi, tf2sos
+from config import *
+
+
+N_COLS = len(EEG_CH_NAMES) + 1 # 32 EEG + MarkerValueInt
+
+
+################################
+class FlexStream():
+    def __init__(
+        self,
+        channels = ("C3", "Cz", "C4"),
+        bandpass = [[8,13]],
+        windows = {"mi": (0,2)},
+        event_ids = EVENT_IDX_8CLASS,
+        offset = 4,
+        sliding = None,
+        unit_factor = 1e6,
+        ):
+        """
+        Stateful filtering + epoching of FLEX sample blocks (n, 33) =
+        EEG_CH_NAMES (V) + MarkerValueInt, as they arrive. EEG is scaled by
+        <unit_factor> (V -> uV, as MOABB/Formulate x), 1 for blocks in uV.
+
+        Filters are causal versions of Flex2023_moabb._flow (1Hz highpass,
+        50Hz notch) and of Formulate.bandpass, their state is kept across
+        blocks. Epochs follow Formulate conventions: <windows> (s) are
+        relative to the cue at <offset> s after the marker (Flex2023
+        interval), x is (channels, times) or (channels, times, bands).
+
+        Args:
+            sliding (tuple): (length, step) in s, to also emit windows
+                every <step> s regardless of markers.
+        Usage:
+            s = FlexStream(channels=("C3", "Cz", "C4"), bandpass=[[8,13]],
+                           windows={"rest": (-4,-2), "mi": (0,2)})
+            for ep in s.run(edf_blocks("F12_8c_ss1_run1.edf")):
+                print(ep["window"], ep["label"], ep["x"].shape)
+            print(s.stats)
+        """
+        self.channels = channels
+        self.bandpass = bandpass
+        self.windows = windows
+        self.event_ids = event_ids
+        self.offset = offset
+        self.sliding = sliding
+        self.unit_factor = unit_factor
+
+        self._picks = [EEG_CH_NAMES.index(ch) for ch in channels]
+        self._labels = {v: k for k, v in event_ids.items()}
+        self._n_bands = 1 if bandpass is None else len(bandpass)
+
+        # epochs as sample ranges relative to the marker (end inclusive, last dropped)
+        self._ranges = {name: (int(round((offset + t[0]) * FS)),
+                               int(round((offset + t[1]) * FS))) \
+                            for name, t in windows.items()}
+        if sliding is not None:
+            self._slide = (int(round(sliding[0] * FS)), int(round(sliding[1] * FS)))
+        history = max([b for _, b in self._ranges.values()] + \
+                      [self._slide[0] if sliding is not None else 0]) + 1
+
+        # filters (sos, zi per channel)
+        sos_hp = butter(4, 1.0, btype="highpass", fs=FS, output="sos")
+        sos_notch = tf2sos(*iirnotch(50, Q=30, fs=FS))
+        self._sos_base = np.vstack([sos_hp, sos_notch])
+        if bandpass is None:
+            self._sos_bands = [None]
+        else:
+            self._sos_bands = [butter(4, band, btype="bandpass", fs=FS, output="sos") \
+                for band in bandpass]
+        self.reset(history)
+
+    #-----------------------------------#
+    def reset(self, history=None):
+        """ clear filter states, buffer and counters """
+
+        n_ch = len(self._picks)
+        if history is not None:
+            self._history = history
+        self._zi_base = None
+        self._zi_bands = [None] * self._n_bands
+        self._buf = np.zeros((n_ch, 0, self._n_bands))
+        self._buf_start = 0 # absolute index of self._buf[:, 0]
+        self._n = 0 # samples received
+        self._last_marker = 0
+        self._pending = [] # (marker_sample, code)
+        self._next_slide = None if self.sliding is None else self._slide[0] - 1
+        self._latency = []
+        self._n_epochs = 0
+        self._t_busy = 0.0
+
+    #-----------------------------------#
+    def _filter(self, eeg):
+        """ causal filters on eeg (channels, n) -> (channels, n, bands) """
+
+        if self._zi_base is None:
+            zi = sosfilt_zi(self._sos_base)
+            self._zi_base = zi[:, None, :] * eeg[None, :, :1]
+        eeg, self._zi_base = sosfilt(self._sos_base, eeg, axis=-1, zi=self._zi_base)
+
+        out = np.empty(eeg.shape + (self._n_bands,))
+        for i, sos in enumerate(self._sos_bands):
+            if sos is None:
+                out[..., i] = eeg
+                continue
+            if self._zi_bands[i] is None:
+                self._zi_bands[i] = np.zeros((sos.shape[0], eeg.shape[0], 2))
+            out[..., i], self._zi_bands[i] = sosfilt(sos, eeg, axis=-1, zi=self._zi_bands[i])
+        return out
+
+    #-----------------------------------#
+    def _slice(self, start, stop):
+        """ buffered samples [start, stop) (absolute) -> (channels, times[, bands]) """
+
+        x = self._buf[:, start-self._buf_start:stop-self._buf_start]
+        return x[..., 0] if self.bandpass is None or self._n_bands == 1 else x
+
+    #-----------------------------------#
+    def push(self, block) -> list:
+        """
+        Process one block (n, 33) of samples, return the epochs completed by it
+            [{"window": "mi", "label": "left_hand", "onset": sample, "x": array}]
+        """
+        t0 = time.perf_counter()
+        block = np.asarray(block, dtype=np.float64)
+        n = block.shape[0]
+
+        # markers: value change to a known event code (int, as mne.find_events)
+        marker = block[:, -1].astype(np.int64)
+        prev = np.concatenate(([self._last_marker], marker[:-1]))
+        for i in np.flatnonzero((marker != prev) & np.isin(marker, list(self._labels))):
+            self._pending.append((self._n + i, int(marker[i])))
+        self._last_marker = marker[-1]
+
+        eeg = block[:, self._picks].T * self.unit_factor
+        self._buf = np.concatenate((self._buf, self._filter(eeg)), axis=1)
+        self._n += n
+
+        epochs = []
+        for onset, code in list(self._pending):
+            ready = all(onset + b < self._n for _, b in self._ranges.values())
+            if not ready:
+                continue
+            for name, (a, b) in self._ranges.items():
+                if onset + a < self._buf_start: # before stream start
+                    continue
+                epochs.append(dict(window=name, label=self._labels[code],
+                    onset=onset, x=self._slice(onset + a, onset + b)))
+            self._pending.remove((onset, code))
+
+        while self._next_slide is not None and self._next_slide < self._n:
+            stop = self._next_slide + 1
+            epochs.append(dict(window="sliding", label=None, onset=stop - self._slide[0],
+                x=self._slice(stop - self._slide[0], stop)))
+            self._next_slide += self._slide[1]
+
+        # keep history (and pending epochs) only
+        keep = self._n - self._history
+        for onset, _ in self._pending:
+            keep = min(keep, onset + min(a for a, _ in self._ranges.values()))
+        if keep > self._buf_start:
+            self._buf = self._buf[:, keep-self._buf_start:]
+            self._buf_start = keep
+
+        dt = time.perf_counter() - t0
+        self._t_busy += dt
+        self._latency.append(dt)
+        self._n_epochs += len(epochs)
+        return epochs
+
+    #-----------------------------------#
+    def run(self, blocks):
+        """ generator of epochs over an iterator of blocks """
+
+        for block in blocks:
+            yield from self.push(block)
+
+    #-----------------------------------#
+    @property
+    def stats(self) -> dict:
+        """
+        Per-block latency (ms) and throughput. realtime_factor > 1 means
+        blocks are processed faster than FS samples/s arrive.
+        """
+        lat = np.array(self._latency) * 1e3
+        throughput = self._n / self._t_busy if self._t_busy > 0 else np.inf
+        return dict(
+            n_blocks=len(lat),
+            n_samples=self._n,
+            n_epochs=self._n_epochs,
+            latency_ms_mean=float(lat.mean()) if len(lat) else 0.0,
+            latency_ms_p99=float(np.percentile(lat, 99)) if len(lat) else 0.0,
+            latency_ms_max=float(lat.max()) if len(lat) else 0.0,
+            throughput=throughput, # samples/s
+            realtime_factor=throughput / FS,
+        )
+
+
+
+################################
+def edf_blocks(edf:str, block_size:int = 32, realtime:bool = False):
+    """
+    Replay a FLEX edf as (block_size, 33) blocks (stand-in for the headset).
+    If <realtime>, blocks are paced at FS.
+    """
+    raw0 = mne.io.read_raw_edf(edf, include=EEG_CH_NAMES + ["MarkerValueInt"],
+                               preload=False, verbose=False)
+    data = raw0.get_data(picks=EEG_CH_NAMES + ["MarkerValueInt"])
+    data[-1] *= 1e6 # marker value, as Flex2023_moabb
+    for i in range(0, data.shape[1], block_size):
+        if realtime:
+            time.sleep(block_size / FS)
+        yield data[:, i:i+block_size].T
+
+
+#-----------------------------------#
+def serve_blocks(blocks, port:int = 5555, host:str = "127.0.0.1"):
+    """
+    Send blocks over a local TCP socket (stand-in for the acquisition
+    software), each as <n:int32> + float32 (n, 33). Runs in a thread.
+    """
+    srv = socket.create_server((host, port))
+
+    def serve():
+        conn, _ = srv.accept()
+        with conn:
+            for block in blocks:
+                block = np.ascontiguousarray(block, dtype="<f4")
+                conn.sendall(struct.pack("<i", block.shape[0]) + block.tobytes())
+        srv.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    return thread
+
+
+#-----------------------------------#
+def socket_blocks(port:int = 5555, host:str = "127.0.0.1"):
+    """ Receive blocks sent by serve_blocks, until the sender closes """
+
+    def recv(conn, n):
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = conn.recv(n - len(buf))
+            if not chunk:
+                return None
+            buf += chunk
+        return bytes(buf)
+
+    with socket.create_connection((host, port)) as conn:
+        while True:
+            head = recv(conn, 4)
+            if head is None:
+                return
+            n = struct.unpack("<i", head)[0]
+            body = recv(conn, n * N_COLS * 4)
+            if body is None:
+                return
+            yield np.frombuffer(body, dtype="<f4").reshape(n, N_COLS)
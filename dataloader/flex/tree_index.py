@@ -0,0 +1,69 @@
+"""
+Incremental listing of dataset folders, shared by the loaders
+(flex/flex2023.py, bk/bk2019.py) to index their files
+
+======================
+Authors: Cuong Pham
+cuongquocpham151@gmail.com
+
+"""
+import os
+import json
+
+
+#=========================#
+def scan_tree(path:str, old:dict = None) -> dict:
+    """
+    Return listing of every folder under <path>
+        {folder: {"mtime": ..., "dirs": [...], "files": {name: mtime}}}
+    Folders whose mtime is unchanged in <old> are not listed again.
+    """
+    old = old or {}
+    tree = {}
+
+    def scan(folder):
+        mtime = os.stat(folder).st_mtime_ns
+        entry = old.get(folder)
+        if entry is None or entry["mtime"] != mtime:
+            dirs, files = [], {}
+            for e in os.scandir(folder):
+                if e.is_dir():
+                    dirs.append(e.name)
+                else:
+                    files[e.name] = e.stat().st_mtime_ns
+            entry = dict(mtime=mtime, dirs=sorted(dirs), files=files)
+        tree[folder] = entry
+        for d in entry["dirs"]:
+            scan(os.path.join(folder, d))
+
+    scan(path)
+    return tree
+
+
+def update_index(root:str, file_index:str, build) -> dict:
+    """
+    Return manifest {"tree": scan_tree(<root>), **build(tree)}, stored in
+    <file_index>. Only folders whose mtime changed since the stored tree
+    are listed again, and the file is only written when the tree changed.
+    """
+    try:
+        with open(file_index, "r") as fid:
+            old = json.load(fid)["tree"]
+    except (OSError, ValueError, KeyError):
+        old = {}
+    tree = scan_tree(root, old)
+    index = dict(tree=tree, **build(tree))
+
+    if tree != old:
+        try:
+            # rewritten in place, so that only creating it changes <root> mtime
+            created = not os.path.isfile(file_index)
+            with open(file_index, "w") as fid:
+                json.dump(index, fid)
+            if created:
+                tree[root]["mtime"] = os.stat(root).st_mtime_ns
+                with open(file_index, "w") as fid:
+                    json.dump(index, fid)
+        except OSError: # read-only dataset, keep in memory
+            pass
+    return index
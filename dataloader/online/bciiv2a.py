@@ -7,8 +7,23 @@ cuongquocpham151@gmail.com
 
 """
 
+import os
+import sys
+from functools import partial
+import numpy as np
+from scipy.io import loadmat
+from joblib import Parallel, delayed
+from mne import create_info
+from mne.channels import make_standard_montage
+from mne.io import RawArray
 from moabb.datasets.base import BaseDataset
-from moabb.datasets.bnci import _convert_mi
+try:
+    from moabb.datasets.bnci import _convert_mi
+except ImportError: # newer moabb (bnci package)
+    from moabb.datasets.bnci.base import _convert_mi
+from decimate import decimate, decimate_stim
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flex")) # shared helpers
+from instrument import instrumented
 # from torcheeg.datasets import BCICIV2aDataset
 # from torcheeg import transforms
 # from torcheeg.model_selection import KFoldCrossSubject
@@ -66,7 +81,7 @@ class BCIIV2a_moabb(BaseDataset):
 
     """
 
-    def __init__(self):
+    def __init__(self, n_jobs=1, fs_resample=None):
         super().__init__(
             subjects=LIST_SUBJECTS,
             sessions_per_subject=2,
@@ -76,7 +91,11 @@ class BCIIV2a_moabb(BaseDataset):
             paradigm="imagery",
             doi="10.3389/fnins.2012.00055",
         )
+        self.n_jobs = n_jobs # processes loading sessions
+        self.fs_resample = fs_resample # decimate while loading, e.g. 250->128
     
+    @instrumented("bciiv2a._get_single_subject_data",
+                  lambda self, subject: dict(subject=subject))
     def _get_single_subject_data(self, subject):
         """
         Return data for a single subject.
@@ -91,14 +110,21 @@ class BCIIV2a_moabb(BaseDataset):
         ch_types = ["eeg"] * 22 + ["eog"] * 3
 
         sessions = {}
-        filenames = []
-        # for session_idx, r in enumerate(["T", "E"]):
-        for session_idx, r in enumerate(["T"]):
+        # list_r = ["T", "E"]
+        list_r = ["T"]
+        filenames = ["{u}/A{s:02d}{r}.mat".format(u=ROOT, s=subject, r=r) \
+            for r in list_r]
 
-            filename = "{u}/A{s:02d}{r}.mat".format(u=ROOT, s=subject, r=r)
-            
-            runs, ev = _convert_mi(filename, EEG_CH_NAMES, ch_types)
+        if self.fs_resample is None:
+            convert = _convert_mi
+        else:
+            convert = partial(_convert_mi_decimated, fs_resample=self.fs_resample)
+
+        out = Parallel(n_jobs=self.n_jobs)(
+            delayed(convert)(filename, EEG_CH_NAMES, ch_types) \
+                for filename in filenames)
 
+        for session_idx, (r, (runs, ev)) in enumerate(zip(list_r, out)):
             sessions[f"{session_idx}{_map[r]}"] = {
                 str(ii): run for ii, run in enumerate(runs)
             }
@@ -111,11 +137,46 @@ class BCIIV2a_moabb(BaseDataset):
 
         return sessions
     
+    @instrumented("bciiv2a.data_path")
     def data_path(self):
         pass
 
 
 
+#=========================#
+def _convert_mi_decimated(filename, ch_names, ch_types, fs_resample):
+    """
+    moabb _convert_mi, with each run decimated to <fs_resample>
+    before its RawArray is built.
+    """
+    runs = []
+    event_id = {}
+    data = loadmat(filename, struct_as_record=False, squeeze_me=True)
+    run_array = data["data"] if isinstance(data["data"], np.ndarray) else [data["data"]]
+
+    for run in run_array:
+        # some runs does not contains trials i.e baseline runs
+        if len(run.trial) == 0:
+            continue
+        trigger = np.zeros(len(run.X))
+        trigger[run.trial - 1] = run.y
+
+        eeg = decimate(run.X.T, run.fs, fs_resample) * 1e-6 # uV -> V
+        trigger = decimate_stim(trigger, run.fs, fs_resample)
+
+        info = create_info(ch_names=ch_names + ["STI"],
+                           ch_types=ch_types + ["stim"],
+                           sfreq=fs_resample)
+        raw = RawArray(data=np.vstack([eeg, trigger]), info=info, verbose=False)
+        raw.set_montage(make_standard_montage("standard_1005"))
+        raw.info["line_freq"] = 50.0
+
+        runs.append(raw)
+        event_id.update({ev: (ii + 1) for ii, ev in enumerate(run.classes)})
+    return runs, event_id
+
+
+
 
 
 #=========================#
@@ -7,13 +7,19 @@ cuongquocpham151@gmail.com
 
 """
 import os
+import sys
+import logging
 import numpy as np
 from scipy.io import loadmat
 from mne import create_info
 from mne.channels import make_standard_montage
 from mne.io import RawArray
 from moabb.datasets.base import BaseDataset
+from decimate import decimate, decimate_stim, decimated_length
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flex")) # shared helpers
+from instrument import instrumented
 
+log = logging.getLogger(__name__)
 
 
 #=========================#
@@ -30,6 +36,8 @@ EEG_CH_NAMES = [
     "FC2", "FCz", "Cz", "C2", "C4", "C6", "T8", "TP8", "CP6", "CP4", "CP2",
     "P2", "P4", "P6", "P8", "P10", "PO8", "PO4", "O2",
 ]
+EMG_CH_NAMES = ["EMG1", "EMG2", "EMG3", "EMG4"]
+N_GAP = 500 # zero samples between the left and right blocks (at FS)
 
 #=========================#
 class Cho2017_moabb(BaseDataset):
@@ -66,9 +74,14 @@ class Cho2017_moabb(BaseDataset):
     to check actual hand movements. Two EMG electrodes were attached to the
     flexor digitorum profundus and extensor digitorum on each arm.
 
+    Args:
+        fs_resample (float): decimate while loading, e.g. 512->128. Defaults to None.
+        channels (list): only load these of EEG_CH_NAMES + EMG_CH_NAMES
+            (+ Stim), all 68 by default. Defaults to None.
+
     """
 
-    def __init__(self):
+    def __init__(self, fs_resample=None, channels=None):
         super().__init__(
             subjects=LIST_SUBJECTS,
             sessions_per_subject=1,
@@ -78,12 +91,16 @@ class Cho2017_moabb(BaseDataset):
             paradigm="imagery",
             doi="10.5524/100295",
         )
-    
+        self.fs_resample = fs_resample # decimate while loading, e.g. 512->128
+        self.channels = channels
+
+    @instrumented("cho2017._get_single_subject_data",
+                  lambda self, subject: dict(subject=subject))
     def _get_single_subject_data(self, subject):
         """Return data for a single subject."""
 
         fname = self.data_path(subject)
-        print(fname)
+        log.debug(fname)
 
         data = loadmat(
             fname,
@@ -94,36 +111,47 @@ class Cho2017_moabb(BaseDataset):
 
 
 
-        # fmt: on
-        emg_ch_names = ["EMG1", "EMG2", "EMG3", "EMG4"]
-        ch_names = EEG_CH_NAMES + emg_ch_names + ["Stim"]
-        ch_types = ["eeg"] * 64 + ["emg"] * 4 + ["stim"]
+        names = EEG_CH_NAMES + EMG_CH_NAMES
+        channels = names if self.channels is None else list(self.channels)
+        picks = [names.index(ch) for ch in channels]
+        ch_names = channels + ["Stim"]
+        ch_types = ["eeg" if ch in EEG_CH_NAMES else "emg" for ch in channels] + ["stim"]
         montage = make_standard_montage("standard_1005")
-        imagery_left = data.imagery_left - data.imagery_left.mean(
-            axis=1, keepdims=True)
-        imagery_right = data.imagery_right - data.imagery_right.mean(
-            axis=1, keepdims=True
-        )
-
-        eeg_data_l = np.vstack([imagery_left * 1e-6, data.imagery_event])
-        eeg_data_r = np.vstack([imagery_right * 1e-6, data.imagery_event * 2])
+        sfreq, fs = data.srate, data.srate
+        n_gap = N_GAP
+        if self.fs_resample is not None:
+            n_gap = int(round(n_gap * self.fs_resample / sfreq))
+            sfreq = self.fs_resample
 
+        # left | zero gap | right, with the event row, written in place
         # trials are already non continuous. edge artifact can appears but
         # are likely to be present during rest / inter-trial activity
-        eeg_data = np.hstack(
-            [eeg_data_l, np.zeros((eeg_data_l.shape[0], 500)), eeg_data_r]
-        )
-        # log.warning(
-        #     "Trials demeaned and stacked with zero buffer to create "
-        #     "continuous data -- edge effects present"
-        # )
-
-
-        info = create_info(ch_names=ch_names, ch_types=ch_types, sfreq=data.srate)
+        blocks = [(data.imagery_left, 1), (data.imagery_right, 2)]
+        lengths = [decimated_length(x.shape[1], fs, sfreq) for x, _ in blocks]
+        eeg_data = np.zeros((len(picks)+1, lengths[0] + n_gap + lengths[1]))
+        starts = [0, lengths[0] + n_gap]
+        event = data.imagery_event
+        if self.fs_resample is not None:
+            event = decimate_stim(event, fs, sfreq)
+        for (x, code), start, n in zip(blocks, starts, lengths):
+            out = eeg_data[:-1, start:start+n]
+            if self.fs_resample is not None:
+                decimate(x, fs, sfreq, picks=picks, out=out)
+                mean = out.mean(axis=1, keepdims=True)
+            else:
+                for i, p in enumerate(picks):
+                    out[i] = x[p]
+                mean = x.mean(axis=1, keepdims=True)[picks] # same sums as on x (F order)
+            out -= mean
+            out *= 1e-6
+            eeg_data[-1, start:start+n] = event * code
+        del data, blocks, x
+
+        info = create_info(ch_names=ch_names, ch_types=ch_types, sfreq=sfreq)
         raw = RawArray(data=eeg_data, info=info, verbose=False)
         raw.set_montage(montage)
 
-        print(raw)
+        log.debug(raw)
         
         # ## CUONG
         # raw1 = raw.copy()
@@ -136,6 +164,7 @@ class Cho2017_moabb(BaseDataset):
 
 
 
+    @instrumented("cho2017.data_path", lambda self, subject, *args, **kwargs: dict(subject=subject))
     def data_path(self, subject, path=None, force_update=False, update_path=None, verbose=None):
         """
         Modified the data_path function, otherwise it will automatically download files again
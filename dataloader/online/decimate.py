@@ -0,0 +1,100 @@
+"""
+Load-time resampling for the high-rate datasets (before RawArray is built)
+
+======================
+Authors: Cuong Pham
+cuongquocpham151@gmail.com
+
+"""
+from fractions import Fraction
+import numpy as np
+from scipy.signal import resample_poly
+
+
+#=========================#
+def _up_down(fs, fs_new):
+    frac = Fraction(str(fs_new)) / Fraction(str(fs))
+    return frac.numerator, frac.denominator
+
+
+def decimated_length(n, fs, fs_new):
+    """ number of samples of <n> samples at <fs> once resampled to <fs_new> """
+    up, down = _up_down(fs, fs_new)
+    return -(-n * up // down) # ceil
+
+
+#=========================#
+def decimate(data, fs, fs_new, chunk=16, picks=None, out=None):
+    """
+    Anti-aliased polyphase resampling of <data> (channels, N) from <fs> to
+    <fs_new>, <chunk> channels at a time -> (channels, N_new) float64.
+    <data> can be a memmap/view, only one chunk of it is read at a time.
+    <picks>: rows of <data> to resample (all by default), <out>: array
+    (len(picks), N_new) to write into (e.g. a slice of a larger buffer).
+    """
+    up, down = _up_down(fs, fs_new)
+    rows = np.arange(data.shape[0]) if picks is None else np.asarray(picks)
+    if out is None:
+        out = np.empty((len(rows), decimated_length(data.shape[1], fs, fs_new)))
+    for i in range(0, len(rows), chunk):
+        if picks is None:
+            x = data[i:i+chunk]
+        else:
+            x = data[rows[i:i+chunk]]
+        out[i:i+chunk] = resample_poly(np.asarray(x, dtype=np.float64),
+                                       up, down, axis=1, padtype="line")
+    return out
+
+
+#=========================#
+def decimate_time(data, fs, fs_new, chunk=2**18, out=None):
+    """
+    decimate() along time, for long recordings with few channels: <data>
+    (channels, N) is read and resampled <chunk> samples at a time, blocks
+    overlap by the filter length and the recording ends are extended as
+    resample_poly(padtype="line") does, so the output is that of
+    decimate() (within float64 precision) -> (channels, N_new) float64.
+    """
+    up, down = _up_down(fs, fs_new)
+    n = data.shape[1]
+    n_new = decimated_length(n, fs, fs_new)
+    if out is None:
+        out = np.empty((data.shape[0], n_new))
+
+    # block bounds on multiples of <down> (whole output samples), overlap
+    # over the half length of resample_poly's default filter
+    pad = -(-(10 * max(up, down) // up + 1) // down) * down
+    step = max(chunk // down, 1) * down
+    if n <= step:
+        return decimate(data, fs, fs_new, out=out)
+
+    first = np.asarray(data[:, :1], dtype=np.float64)
+    last = np.asarray(data[:, -1:], dtype=np.float64)
+    slope = (last - first) / (n - 1) # "line": trend of the first/last samples
+    for start in range(0, n, step):
+        stop = min(start + step, n)
+        lo, hi = start - pad, stop + pad
+        x = np.empty((data.shape[0], hi - lo))
+        x[:, max(-lo, 0):min(n, hi) - lo] = data[:, max(lo, 0):min(n, hi)]
+        if lo < 0:
+            x[:, :-lo] = first + slope * np.arange(lo, 0)
+        if hi > n:
+            x[:, n-lo:] = last + slope * np.arange(1, hi - n + 1)
+        x = resample_poly(x, up, down, axis=1, padtype="line")
+        i, j = start * up // down, (n_new if stop == n else stop * up // down)
+        skip = pad * up // down
+        out[:, i:j] = x[:, skip:skip + j - i]
+    return out
+
+
+#=========================#
+def decimate_stim(stim, fs, fs_new):
+    """ Move nonzero event codes of <stim> (N,) to their sample at <fs_new> """
+
+    stim = np.asarray(stim)
+    up, down = _up_down(fs, fs_new)
+    n_new = decimated_length(stim.shape[0], fs, fs_new)
+    idx = np.flatnonzero(stim)
+    out = np.zeros(n_new, dtype=stim.dtype)
+    out[np.minimum(np.round(idx * up / down).astype(int), n_new-1)] = stim[idx]
+    return out
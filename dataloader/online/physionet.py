@@ -7,10 +7,20 @@ Authors: Cuong Pham
 cuongquocpham151@gmail.com
 
 """
+import os
+import sys
+import io
+import time
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import mne
+from joblib import Parallel, delayed
 from mne.io import read_raw_edf
 from moabb.datasets.base import BaseDataset
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flex")) # shared helpers
+from instrument import instrumented
 
 
 
@@ -26,6 +36,91 @@ EEG_CH_NAMES = {
 }
 
 
+#=========================#
+@functools.lru_cache(maxsize=None)
+def _montage():
+    """ standard_1005 montage, built once (set_montage does not modify it) """
+    return mne.channels.make_standard_montage("standard_1005")
+
+
+@functools.lru_cache(maxsize=None)
+def _rename_mapping(ch_names:tuple) -> dict:
+    """ "Fc5." -> "FC5", "Cz.." -> "Cz", ... for the channel names of one edf """
+    mapping = {}
+    for ch in ch_names:
+        name = ch.strip(".").upper()
+        mapping[ch] = EEG_CH_NAMES.get(name, name)
+    return mapping
+
+
+################################
+class Prefetcher():
+    """
+    Read whole files into memory on <n_threads> background threads, so
+    that the next files are fetched while the current one is decoded.
+    stats: "read_seconds" spent reading, "wait_seconds" the consumer was
+    blocked on a read, "hidden_seconds" = read - wait (I/O wait overlapped
+    with decoding).
+
+    Usage:
+        prefetcher = Prefetcher(4)
+        prefetcher.prefetch(paths)
+        for path in paths:
+            raw = read_raw_edf(prefetcher.get(path), preload=True)
+        print(prefetcher.stats)
+    """
+    def __init__(self, n_threads:int = 4):
+        self._pool = ThreadPoolExecutor(n_threads, thread_name_prefix="prefetch")
+        self._futures = {} # {path: Future of bytes}
+        self._lock = threading.Lock()
+        self.n_files = 0
+        self.read_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def _read(self, path):
+        t0 = time.perf_counter()
+        with open(path, "rb") as fid:
+            data = fid.read()
+        with self._lock:
+            self.n_files += 1
+            self.read_seconds += time.perf_counter() - t0
+        return data
+
+    def prefetch(self, paths) -> None:
+        """ start reading <paths> not queued yet, in order """
+        with self._lock:
+            for path in paths:
+                if path not in self._futures:
+                    self._futures[path] = self._pool.submit(self._read, path)
+
+    def get(self, path:str) -> io.BytesIO:
+        """ content of <path> (read now if it was not prefetched) """
+        self.prefetch([path])
+        with self._lock:
+            future = self._futures.pop(path)
+        t0 = time.perf_counter()
+        data = future.result()
+        with self._lock:
+            self.wait_seconds += time.perf_counter() - t0
+        return io.BytesIO(data)
+
+    def discard(self) -> int:
+        """ drop files prefetched but not taken by get() (cancel pending reads) """
+        with self._lock:
+            futures, self._futures = self._futures, {}
+        for future in futures.values():
+            future.cancel()
+        return len(futures)
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(n_files=self.n_files, read_seconds=self.read_seconds,
+                        wait_seconds=self.wait_seconds,
+                        hidden_seconds=max(self.read_seconds - self.wait_seconds, 0.0))
+
+
+################################
 class PhysionetMI_moabb(BaseDataset):
     """
     >> replace moabb.datasets.PhysionetMI
@@ -60,9 +155,16 @@ class PhysionetMI_moabb(BaseDataset):
     6, 10, 14  Motor imagery: hands vs feet
     =========  ===================================
 
+    prefetch (int): threads reading the next runs (and the next subject's
+        runs) while the current run is decoded, 0 reads each edf when it is
+        decoded. I/O wait hidden so far: self.prefetch_stats.
+        The next subject is only known within one get_data(subjects) call:
+        single-subject calls (e.g. Formulate) only prefetch their own runs.
+        Files not used by the end of get_data() are dropped.
+
     """
 
-    def __init__(self, imagined=True, executed=False):
+    def __init__(self, imagined=True, executed=False, n_jobs=1, prefetch=0):
         super().__init__(
             subjects = LIST_SUBJECTS,
             sessions_per_subject = 1,
@@ -77,6 +179,10 @@ class PhysionetMI_moabb(BaseDataset):
 
         self.imagined = imagined
         self.executed = executed
+        self.n_jobs = n_jobs # processes loading runs
+        self.prefetch = prefetch
+        self._prefetcher = None
+        self._subjects = [] # subjects of the current get_data(), to prefetch the next one
         self.feet_runs = []
         self.hand_runs = []
 
@@ -90,51 +196,80 @@ class PhysionetMI_moabb(BaseDataset):
         
     
 
+    def __getstate__(self):
+        # thread pool stays in this process, workers make their own
+        state = self.__dict__.copy()
+        state["_prefetcher"] = None
+        return state
+
+    @property
+    def prefetch_stats(self) -> dict:
+        return self._prefetcher.stats if self._prefetcher is not None else {}
+
+    def _run_paths(self, subject):
+        runs = self.hand_runs + self.feet_runs
+        return self._load_data(subject, runs=runs)
+
     def _load_one_run(self, subject, run, preload=True):
         raw_fname = self._load_data(subject, runs=[run], verbose="ERROR")[0]
+        if self._prefetcher is not None:
+            raw_fname = self._prefetcher.get(raw_fname) # file-like, needs preload
+            preload = True
         raw = read_raw_edf(raw_fname, preload=preload, verbose="ERROR")
-        raw.rename_channels(lambda x: x.strip("."))
-        raw.rename_channels(lambda x: x.upper())
+        raw.rename_channels(_rename_mapping(tuple(raw.ch_names)))
+        raw.set_montage(_montage())
+        return raw
+
 
-        raw.rename_channels(EEG_CH_NAMES)
-        raw.set_montage(mne.channels.make_standard_montage("standard_1005"))
+    def _load_annotated_run(self, subject, run, t1, t2):
+        """Load one run, rename annotations T0/T1/T2 -> rest/<t1>/<t2>"""
+        raw = self._load_one_run(subject, run)
+        stim = raw.annotations.description.astype(np.dtype("<U10"))
+        stim[stim == "T0"] = "rest"
+        stim[stim == "T1"] = t1
+        stim[stim == "T2"] = t2
+        raw.annotations.description = stim
         return raw
 
 
+    @instrumented("physionet._get_single_subject_data",
+                  lambda self, subject: dict(subject=subject))
     def _get_single_subject_data(self, subject):
         """Return data for a single subject."""
-        data = {}
         # sign = "EEGBCI"
         # get_dataset_path(sign, self.root)
 
-        # hand runs
-        idx = 0
-        for run in self.hand_runs:
-            raw = self._load_one_run(subject, run)
-            stim = raw.annotations.description.astype(np.dtype("<U10"))
-            stim[stim == "T0"] = "rest"
-            stim[stim == "T1"] = "left_hand"
-            stim[stim == "T2"] = "right_hand"
-            raw.annotations.description = stim
-            data[str(idx)] = raw
-            idx += 1
-
-        # feet runs
-        for run in self.feet_runs:
-            raw = self._load_one_run(subject, run)
-            # modify stim channels to match new event ids. for feet runs,
-            # hand = 2 modified to 4, and feet = 3, modified to 5
-            stim = raw.annotations.description.astype(np.dtype("<U10"))
-            stim[stim == "T0"] = "rest"
-            stim[stim == "T1"] = "hands"
-            stim[stim == "T2"] = "feet"
-            raw.annotations.description = stim
-            data[str(idx)] = raw
-            idx += 1
+        # hand runs, then feet runs. for feet runs, modify stim channels
+        # to match new event ids: hand = 2 modified to 4, and feet = 3, modified to 5
+        tasks = [(run, "left_hand", "right_hand") for run in self.hand_runs] \
+            + [(run, "hands", "feet") for run in self.feet_runs]
 
+        if self.prefetch:
+            if self._prefetcher is None:
+                self._prefetcher = Prefetcher(self.prefetch)
+            self._prefetcher.prefetch(self._run_paths(subject))
+            if subject in self._subjects[:-1]:
+                following = self._subjects[self._subjects.index(subject) + 1]
+                self._prefetcher.prefetch(self._run_paths(following))
+
+        list_raw = Parallel(n_jobs=self.n_jobs,
+                            prefer="threads" if self.prefetch else None)(
+            delayed(self._load_annotated_run)(subject, *task) for task in tasks)
+
+        data = {str(idx): raw for idx, raw in enumerate(list_raw)}
         return {"0": data}
 
 
+    def get_data(self, subjects=None, *args, **kwargs):
+        self._subjects = list(self.subject_list if subjects is None else subjects)
+        try:
+            return super().get_data(subjects, *args, **kwargs)
+        finally:
+            if self._prefetcher is not None:
+                self._prefetcher.discard()
+
+
+    @instrumented("physionet.data_path", lambda self, subject, *args, **kwargs: dict(subject=subject))
     def data_path(
         self, subject, path=None, force_update=False, update_path=None, verbose=None
     ):
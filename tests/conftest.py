@@ -0,0 +1,21 @@
+import os
+import sys
+import io
+import contextlib
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "dataloader"))
+
+import benchmark # adds flex/, bk/, online/ to the path
+
+
+#=========================#
+@pytest.fixture
+def fixture(tmp_path):
+    """ setup(name, subjects, n_trials) -> dataset on synthetic files (benchmark.setup) """
+
+    def setup(name, subjects=(1,), n_trials=16):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return benchmark.setup(name, str(tmp_path), list(subjects), n_trials)
+    return setup
@@ -0,0 +1,19 @@
+import os
+import numpy as np
+import bk2019
+
+
+#=========================#
+def test_convert_txt(tmp_path, monkeypatch):
+    """ chunked txt -> float32 npy = np.loadtxt of the whole file """
+
+    monkeypatch.setattr(bk2019, "CHUNK_ROWS", 1000)
+    data = np.random.default_rng(0).standard_normal((2500, 7)) * 20
+    file_data = str(tmp_path / "run.txt")
+    np.savetxt(file_data, data, fmt="%.4f", header="C3 Cz C4 P3 Pz P4 ECG", comments="")
+    bk2019.convert_txt(file_data, file_data + ".npy")
+
+    x = np.load(file_data + ".npy")
+    assert x.dtype == np.float32
+    assert np.array_equal(x, np.loadtxt(file_data, dtype="<f4", skiprows=1))
+    assert not [i for i in os.listdir(tmp_path) if ".tmp" in i]
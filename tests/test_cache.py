@@ -0,0 +1,37 @@
+import numpy as np
+from cache import EpochCache, source_files
+
+
+#=========================#
+def test_key_stable_after_load(fixture, tmp_path):
+    """ derived files of a first load (bk2019 npy/event tables) do not change the key """
+
+    dataset = fixture("bk2019", n_trials=8)
+    cache = EpochCache(str(tmp_path / "cache"))
+    files = source_files(dataset, 1)
+    key = cache.key(dataset, 1, interval=(0, 2))
+    dataset.get_data([1])
+    assert source_files(dataset, 1) == files
+    assert cache.key(dataset, 1, interval=(0, 2)) == key
+
+
+#=========================#
+def test_key_execution_settings(fixture, tmp_path):
+    """ worker/prefetch settings do not change the key """
+
+    dataset = fixture("physionet")
+    cache = EpochCache(str(tmp_path / "cache"))
+    key = cache.key(dataset, 1, interval=(0, 2))
+    dataset.n_jobs, dataset.prefetch = 4, False
+    assert cache.key(dataset, 1, interval=(0, 2)) == key
+
+
+def test_hit_writable(tmp_path):
+    """ a hit is writable like a miss, the entry is left as it is """
+
+    cache = EpochCache(str(tmp_path / "cache"))
+    x = np.arange(24, dtype=float).reshape(2, 3, 4)
+    cache.put("k", x, np.array(["a", "b"]), None)
+    x_hit, y_hit, _ = cache.get("k")
+    x_hit[0] = -1
+    assert np.array_equal(cache.get("k")[0], x)
@@ -0,0 +1,13 @@
+import numpy as np
+import pytest
+from decimate import decimate, decimate_time
+
+
+#=========================#
+@pytest.mark.parametrize("fs, n", [(500, 500 * 60 + 37), (512, 512 * 20 + 3), (500, 100)])
+def test_decimate_time(fs, n):
+    """ blocks along time (bk2019 memmap) = decimate() of the whole recording """
+
+    x = np.cumsum(np.random.default_rng(0).standard_normal((6, n)), axis=1).astype(np.float32)
+    expected = decimate(x, fs, 128)
+    assert np.allclose(decimate_time(x, fs, 128, chunk=4096), expected, rtol=0, atol=1e-9)
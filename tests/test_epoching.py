@@ -0,0 +1,27 @@
+import numpy as np
+import mne
+import pytest
+from epoching import raw_events, bad_spans, kept_events
+
+
+#=========================#
+@pytest.mark.parametrize("meas_date", [None, 1e9])
+def test_kept_events(meas_date):
+    """ events kept at the edges / off "bad*" annotations = mne.Epochs """
+
+    sfreq, n = 100., 6000
+    stim = np.zeros(n)
+    stim[[50, 1000, 2000, 3000, 5900]] = [1, 2, 1, 2, 1]
+    info = mne.create_info(["C3", "STI"], sfreq, ["eeg", "stim"])
+    raw = mne.io.RawArray(np.vstack([np.zeros(n), stim]), info, first_samp=350, verbose=False)
+    raw.set_meas_date(meas_date)
+    raw.set_annotations(mne.Annotations([11.5, 25.0], [1.0, 0.2], ["bad_motion", "note"]))
+
+    event_id = dict(a=1, b=2)
+    events = raw_events(raw, event_id)
+    _, ok = kept_events(events[:, 0], raw.n_times, sfreq, bad_spans(raw), -1, 2)
+
+    mne_events = mne.find_events(raw, shortest_event=0, verbose=False)
+    epochs = mne.Epochs(raw, mne_events, event_id, tmin=-1, tmax=2, baseline=None,
+                        reject_by_annotation=True, preload=True, verbose=False)
+    assert np.array_equal(events[ok, 0] + raw.first_samp, epochs.events[:, 0])
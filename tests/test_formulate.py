@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+import benchmark
+from config import EVENT_IDX_4CLASS
+from filterbank import FLOAT32_RTOL
+from formulate import Formulate
+
+
+#=========================#
+@pytest.mark.parametrize("native_epochs", [False, True])
+def test_2class_dataset(fixture, native_epochs):
+    """ 4c sub-tasks of a dataset with left/right hand only (superset not valid for MOABB) """
+
+    dataset = fixture("cho2017")
+    f = Formulate(dataset, subject=1, native_epochs=native_epochs)
+    x, y, le = f.form("4c_2class_hand")
+    assert x.shape[:2] == (32, 3)
+    assert list(le.classes_) == ["left_hand", "right_hand"]
+
+    d = Formulate(dataset, subject=1, native_epochs=native_epochs).form_many(
+        ["4c_2class_hand", "4c_all"])
+    assert np.array_equal(d["4c_2class_hand"][0], x)
+
+
+def test_2class_sweep(fixture):
+    """ each grid point = form() of a fresh instance, the instance is left as it is """
+
+    dataset = fixture("cho2017")
+    f = Formulate(dataset, subject=1)
+    x0, y0, _ = f.form("4c_2class_hand")
+    sweep = lambda: f.sweep("4c_2class_hand", intervals=[(0.5, 2.5), (0, 2)],
+                            bandpasses=[[[13, 30]], [[8, 13]]])
+
+    grid = sweep()
+    next(grid) # not exhausted nor closed
+    assert (f.t_mi, f.bandpass) == ((0, 2), [[8, 13]])
+    x, y, _ = f.form("4c_2class_hand")
+    assert np.array_equal(x, x0) and np.array_equal(y, y0)
+
+    for (t_mi, bandpass), (x, y, le) in sweep():
+        x_ref, y_ref, _ = Formulate(dataset, subject=1, t_mi=t_mi,
+                                    bandpass=bandpass).form("4c_2class_hand")
+        assert x.shape == x_ref.shape and np.array_equal(y, y_ref)
+        assert np.allclose(x, x_ref)
+
+
+#=========================#
+@pytest.mark.parametrize("name", ["bk2019", "cho2017", "physionet"])
+def test_windows_not_128hz(fixture, name):
+    """ windows sliced from a wide epoch = direct extraction, dataset rate != FS """
+
+    dataset = fixture(name)
+    events = Formulate(dataset, subject=1)._available(EVENT_IDX_4CLASS)
+    x_direct, y_direct = Formulate(dataset, subject=1).epochs(events, (0, 2))
+
+    f = Formulate(dataset, subject=1)
+    f.epochs(events, (-4, 2))
+    x, y = f.epochs(events, (0, 2))
+    assert x.shape == x_direct.shape and np.array_equal(y, y_direct)
+    assert np.allclose(x, x_direct)
+
+    x, y, le = Formulate(dataset, subject=1).form("4c_rest")
+    assert x.shape[2] == x_direct.shape[2] - 1
+
+
+#=========================#
+def test_many_edge_trials(tmp_path):
+    """ a window keeps its trials when a wider one drops the last (short recording) """
+
+    benchmark.make_flex(str(tmp_path), [12], n_trials=8, n_runs=1, t_end=7)
+    dataset = benchmark.Flex2023_moabb(dir_raw_data=str(tmp_path), protocol="8c",
+                                       session="ss1", run="-1")
+    x, y, le = Formulate(dataset, subject=12).form("8c_mi")
+    assert len(y) == 8
+
+    d = Formulate(dataset, subject=12).form_many(["8c_mi", "8c_rest"])
+    assert np.array_equal(d["8c_mi"][0], x) and np.array_equal(d["8c_mi"][1], y)
+    assert len(d["8c_rest"][1]) == 7
+
+
+#=========================#
+@pytest.mark.parametrize("name, model_name", [("flex2023", "8c_mi"), ("cho2017", "4c_2class_hand")])
+@pytest.mark.parametrize("bandpass", [[[8, 13]], [[8, 13], [13, 30]]])
+def test_float32(fixture, name, model_name, bandpass):
+    """ float32 native epochs within FLOAT32_RTOL of float64 """
+
+    subject = 12 if name == "flex2023" else 1 # Flex2023_moabb loads F12 onwards
+    dataset = fixture(name, subjects=[subject])
+    kwargs = dict(subject=subject, bandpass=bandpass, native_epochs=True)
+    x64, y64, _ = Formulate(dataset, **kwargs).form(model_name)
+    x32, y32, _ = Formulate(dataset, dtype="float32", **kwargs).form(model_name)
+
+    assert x32.dtype == np.float32 and x32.shape == x64.shape
+    assert np.array_equal(y32, y64)
+    x64 = x64.reshape(*x64.shape[:3], -1) # per band
+    error = np.abs(x32.reshape(x64.shape) - x64).max(axis=(0, 1, 2)) / np.abs(x64).max(axis=(0, 1, 2))
+    assert (error <= FLOAT32_RTOL).all()
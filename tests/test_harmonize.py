@@ -0,0 +1,32 @@
+import os
+import numpy as np
+from store import EpochStore
+from harmonize import harmonize
+
+
+#=========================#
+def test_harmonize(fixture, tmp_path):
+    """ selected subjects only, failures reported, shards kept across runs """
+
+    datasets = dict(flex2023=fixture("flex2023", subjects=[12], n_trials=8),
+                    physionet=fixture("physionet", n_trials=8))
+    root = str(tmp_path / "store")
+    kwargs = dict(labels=["left_hand", "right_hand"],
+                  subjects=dict(flex2023=[12, 13], physionet=[1])) # no F13 files
+
+    report = harmonize(datasets, root, **kwargs)
+    assert report["added"] == ["flex2023-sub-012", "physionet-sub-001"]
+    assert report["failed"] == ["flex2023-sub-013"]
+
+    store = EpochStore(root)
+    assert [i["name"] for i in store.info["shards"]] == report["added"]
+    assert sorted(store.info["labels"]) == ["left_hand", "right_hand"]
+    shapes = [i["shape"] for i in store.info["shards"]]
+    assert shapes[0][1:] == shapes[1][1:] and shapes[0][2] == 256
+
+    # execution-only settings keep the shards, the failure is retried
+    mtime = os.stat(os.path.join(root, "shards", "physionet-sub-001", "x.npy")).st_mtime_ns
+    datasets["physionet"].prefetch = not datasets["physionet"].prefetch
+    report = harmonize(datasets, root, **kwargs)
+    assert report == dict(added=[], failed=["flex2023-sub-013"], unchanged=2)
+    assert os.stat(os.path.join(root, "shards", "physionet-sub-001", "x.npy")).st_mtime_ns == mtime
@@ -0,0 +1,67 @@
+import threading
+import numpy as np
+import pytest
+import formulate
+from server import EpochServer, EpochClient
+
+
+#=========================#
+@pytest.fixture
+def count_form(monkeypatch):
+    """ number of Formulate.form calls """
+
+    calls = []
+    form = formulate.Formulate.form
+    def counted(self, model_name):
+        calls.append((self.subject, model_name))
+        return form(self, model_name)
+    monkeypatch.setattr(formulate.Formulate, "form", counted)
+    return calls
+
+
+def test_preload_kept_across_clients(fixture, count_form):
+    dataset = fixture("flex2023", subjects=[12])
+    with EpochServer(dataset) as server:
+        server.preload([12], ["8c_mi"])
+        assert len(count_form) == 1
+        for _ in range(3): # sequential tasks, one client each
+            with EpochClient(*server.connection) as client:
+                x, y, le = client.get(12, "8c_mi")
+                assert x.shape[0] == len(y)
+            assert server.stats["bytes"] > 0
+        assert len(count_form) == 1
+
+        server.evict(12, "8c_mi")
+        assert server.stats["bytes"] == 0
+
+
+def test_release_frees_on_demand_entries(fixture, count_form):
+    dataset = fixture("flex2023", subjects=[12])
+    with EpochServer(dataset) as server:
+        with EpochClient(*server.connection) as client:
+            x, y, le = client.get(12, "8c_mi")
+            x2, _, _ = client.get(12, "8c_mi")
+            assert np.array_equal(x, x2)
+        assert len(count_form) == 1
+        assert server.stats["bytes"] == 0
+
+
+def test_concurrent_acquire_release(fixture, count_form):
+    dataset = fixture("flex2023", subjects=[12])
+    errors = []
+    with EpochServer(dataset) as server:
+        def work():
+            try:
+                for _ in range(20):
+                    handle = server.acquire(12, "8c_mi")
+                    np.load(handle["y"])
+                    server.release(12, "8c_mi")
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        assert server.stats == dict(refs={}, pinned=[], bytes=0)
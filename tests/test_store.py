@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+from store import EpochStore, EpochDataset
+
+
+#=========================#
+def test_store(tmp_path):
+    """ shards -> index, filtered dataset and batches in index order """
+
+    rng = np.random.default_rng(0)
+    store = EpochStore(str(tmp_path / "store"))
+    x1 = rng.standard_normal((4, 3, 8)).astype(np.float32)
+    x2 = rng.standard_normal((2, 3, 8)).astype(np.float32)
+    metadata = pd.DataFrame(dict(subject=[1] * 4, session=["0"] * 4, run=["0", "0", "1", "1"]))
+    store.add("sub-001", x1, ["a", "b", "a", "b"], metadata, dataset="d1")
+    store.add("sub-002", x2, ["b", "b"], subject=2, dataset="d2")
+
+    assert len(store.index) == 6
+    assert store.info["labels"] == ["a", "b"]
+    assert list(store.index["subject"]) == [1, 1, 1, 1, 2, 2]
+
+    data = EpochDataset(store, labels=["b"])
+    x, y = data.get_batch(np.arange(len(data)))
+    assert np.array_equal(x, np.concatenate([x1[[1, 3]], x2]))
+    assert np.array_equal(y, [0, 0, 0, 0])
+
+    store.remove("sub-002")
+    assert len(EpochStore(store.root).index) == 4
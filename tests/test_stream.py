@@ -0,0 +1,24 @@
+import os
+import numpy as np
+from config import EVENT_IDX_8CLASS
+from formulate import Formulate
+from stream import FlexStream, edf_blocks
+
+
+#=========================#
+def test_stream_matches_formulate(fixture):
+    """ same trials, labels and units (uV) as Formulate, up to causal vs zero-phase filters """
+
+    dataset = fixture("flex2023", subjects=[12])
+    dataset.run = "F12_8c_ss1_run1.edf"
+    x, y = Formulate(dataset, subject=12).epochs(EVENT_IDX_8CLASS, (0, 2))
+    x = x[:, :, :-1]
+
+    edf = os.path.join(dataset.dir_raw_data, dataset.run)
+    epochs = list(FlexStream().run(edf_blocks(edf)))
+    xs = np.stack([e["x"] for e in epochs])
+
+    assert [e["label"] for e in epochs] == list(y)
+    assert xs.shape == x.shape
+    ratio = xs.std(axis=(1, 2)) / x.std(axis=(1, 2))
+    assert np.all((ratio > 0.8) & (ratio < 1.25))